@@ -26,13 +26,14 @@ from tqdm import tqdm
 import glob
 from rich import print, inspect
 
-from topological_feature_extractor import topo_psf_feature_extract
+from topological_feature_extractor import topo_psf_feature_extract, topo_psf_feature_extract_multi, fill_uncovered
 from run_crossval import run_crossval_xgb, run_crossval_mlp
 import logging
 logging.basicConfig(level=logging.INFO)
 
 import warnings
 # from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
 
 
@@ -43,8 +44,29 @@ PATCH_SIZE: int = 2 # Stimulation patch size used in PSF
 STIM_LEVEL: int = 4 # Number of stimulation level used in PSF
 N_SAMPLE_NEURONS: int = 1.5e3  # Number of neurons for sampling
 USE_EXAMPLE: bool =  True     # Whether clean inputs will be given or not
-CORR_METRIC: str = 'distcorr'   # Correlation metric to be used
+CORR_METRIC: str = 'distcorr'   # Correlation metric to be used, choice = {distcorr, distcorr_fast, distcorr_sketch, bc, cos, pearson, js}
+CORR_METHODS: List = None       # Further metrics computed from the same probing pass, e.g. ['pearson', 'cos'], see fv['metric_features']
 CLASSIFIER: str  = 'xgboost'    # Classifier for the detection , choice = {xgboost, mlp}.
+PROBE_MEM_MB: int = 1024       # Memory budget (MB) of one batch of PSF probes
+INCREMENTAL: bool = False      # Recompute only the receptive field touched by the PSF patch
+ACT_REDUCER: str = 'max'       # Spatial reducer of conv layer inputs, choice = {max, mean, l2, topk_mean, quantile}
+LAYER_SELECT: dict = {}        # Layers of the activation graph, keys {pattern, range, types}, empty for all Conv2d/Linear
+PRECISION: str = 'fp32'        # Precision of the probe forwards, choice = {fp32, bf16, int8}
+COMPILE: str = None            # Compile the probe graph once per architecture, choice = {None, jit, inductor}
+SCAN: str = 'uniform'          # PSF scan of the input, choice = {uniform, adaptive} (coarse-to-fine)
+STIM_SEARCH: str = 'grid'      # Stimulation levels probed at a position, choice = {grid, adaptive} (bisection)
+SCAN_ORDER: str = None         # Order the positions are visited in, choice = {raster, random, space_filling}, None for space_filling under a TIME_BUDGET and raster otherwise
+TIME_BUDGET: float = None      # Wall-clock budget (s) of the feature extraction of one model, None for no budget
+DCOR_MEM_MB: int = 1024        # Memory cap (MB) of the distcorr and js intermediates, larger activation graphs are computed blockwise
+CORR_THREADS: int = None       # Threads of the correlation metric, None for all cores
+SKETCH_TOL: float = 0.02       # Target error of distcorr_sketch, reported in the features as corr_error
+GREEDY_CUTOFF: float = None    # Insertion radius at which the furthest point sampling of the sparse filtration stops, None for exact
+MAXDIM: int = 1                # Highest homology dimension of the topological features, 0 uses the spanning tree H0 engine
+FILTRATION: str = 'auto'       # Filtration of the persistent diagrams, choice = {auto, exact, sparse, threshold}, see plan_filtration
+PH_TIME_BUDGET: float = None   # Ripser time budget (s) of a position the filtration is planned for, None for size based planning
+PH_WORKERS: int = 0            # Processes computing the persistent diagrams while probing goes on, 0 for in process
+PH_QUEUE_DEPTH: int = None     # Distance matrices waiting for a persistent homology worker at most, None for 2*PH_WORKERS
+MODEL_BATCH: int = 1           # Number of same-architecture models probed together in one vmap-ed forward
 # Experiment Configuration
 # INPUT_SIZE: List = [1, 28, 28] # Input images' shape (default to be MNIST) # TODO
 INPUT_SIZE: List = [3, 224, 224] # Input images' shape (default to be MNIST) # TODO
@@ -52,137 +74,154 @@ INPUT_RANGE: List = [0, 255]   # Input image range
 TRAIN_TEST_SPLIT: float = 0.8  # Ratio of train to test
 
 
-# def process_model(j, model_list, gt_list, fv_list, gt_list_lock, fv_list_lock, root, device, psf_config):
-def process_model(args):
+def load_model(j, model_list, root, device):
+    """
+    Load the j-th model of model_list together with its ground truth and clean class examples.
+    Input args:
+        j (int): index of the model in model_list
+        model_list (List): model folder names under root
+        root (str): root folder of the experiment models
+        device (torch.device): device the model is loaded to
+    Return:
+        None if the model is skipped, otherwise a dict with model_name, arch, save_file_dir, model, gt and img_c
+    """
+    model_name = model_list[j]
+    model_file_path = []
+    model_config_path = []
+    model_train_example_config = None
+    gt_file = None
+    USE_EXAMPLE = True
+
+    save_file_dir = os.path.join(
+            os.path.dirname(root),
+            "calculated_features_cache",
+            model_name
+            )
+
+    save_file_path = os.path.join(
+            save_file_dir,
+            "fv.pkl",
+            )
+    # The sample and filtration plans are cached before extraction, only the feature file marks a finished model
+    if os.path.exists(save_file_path):
+        logging.info("Skipping model {} as it has been processed".format(model_name))
+        return
+
+    if not os.path.exists(save_file_dir):
+        os.makedirs(save_file_dir)
+
+
+    """for root_m, dirnames, filenames in os.walk(os.path.join(root, model_name)):
+        for filename in filenames:
+            if filename.endswith('.pt'):
+                model_file_path = os.path.join(root_m, filename)
+            if filename.endswith('ground_truth.csv'):
+                gt_file = os.path.join(root_m, filename)
+            if filename.endswith('config.json'):
+                model_config_path = os.path.join(root_m, filename)
+            if filename.endswith('experiment_train.csv'):
+                model_train_example_config = os.path.join(root_m, filename) # TODO
+        if len(model_file_path) and len(model_config_path) and model_train_example_config:
+            break
+    """
+    model_file_path = os.path.join(root, model_name, "model.pt")
+    gt_file = os.path.join(root, model_name, "ground_truth.csv")
+    model_train_example_config = os.path.join(
+            root,
+            model_name,
+            "clean-example-data",
+            "data.csv")
+    model_stats_file = os.path.join(root, model_name, "model_stats.json")
+    # load the model stats
     try:
-        j, model_list, gt_list, fv_list, root, device, psf_config = args
-
-        model_name = model_list[j]
-        model_file_path = []
-        model_config_path = []
-        model_train_example_config = None
-        gt_file = None
-        USE_EXAMPLE = True
-
-        save_file_dir = os.path.join(
-                os.path.dirname(root),
-                "calculated_features_cache",
-                model_name
-                )
-
-        save_file_path = os.path.join(
-                save_file_dir,
-                "fv.pkl",
-                )
-        if os.path.exists(save_file_dir) and len(os.listdir(save_file_dir)) > 0:
-            logging.info("Skipping model {} as it has been processed".format(model_name))
+        model_stats = json.load(open(model_stats_file, "r"))
+        if model_stats["name"] == "inceptionv3":
+            logging.info("Skipping model {} as it is inceptionv3".format(model_name))
             return
+    except:
+        logging.error("err loading model stats".format(model_name))
+        return
 
-        if not os.path.exists(save_file_dir):
-            os.makedirs(save_file_dir)
-
-
-        """for root_m, dirnames, filenames in os.walk(os.path.join(root, model_name)):
-            for filename in filenames:
-                if filename.endswith('.pt'):
-                    model_file_path = os.path.join(root_m, filename)
-                if filename.endswith('ground_truth.csv'):
-                    gt_file = os.path.join(root_m, filename)
-                if filename.endswith('config.json'):
-                    model_config_path = os.path.join(root_m, filename)
-                if filename.endswith('experiment_train.csv'):
-                    model_train_example_config = os.path.join(root_m, filename) # TODO
-            if len(model_file_path) and len(model_config_path) and model_train_example_config:
-                break
-        """
-        model_file_path = os.path.join(root, model_name, "model.pt")
-        gt_file = os.path.join(root, model_name, "ground_truth.csv")
-        model_train_example_config = os.path.join(
-                root,
-                model_name,
-                "clean-example-data",
-                "data.csv")
-        model_stats_file = os.path.join(root, model_name, "model_stats.json")
-        # load the model stats
-        try:
-            model_stats = json.load(open(model_stats_file, "r"))
-            if model_stats["name"] == "inceptionv3":
-                logging.info("Skipping model {} as it is inceptionv3".format(model_name))
-                return
-        except:
-            logging.error("err loading model stats".format(model_name))
-            return
+    try:
+        model_file_path = model_file_path
+        model = torch.load(model_file_path, map_location=device).to(device)
+    except Exception as e:
+        logging.error("err loading {} skipping to next model".format(model_name))
+        print(e)
+        return
 
-        try:
-            model_file_path = model_file_path
-            model = torch.load(model_file_path, map_location=device).to(device)
-        except Exception as e:
-            logging.error("err loading {} skipping to next model".format(model_name))
-            print(e)
-            return
+    model.eval()
 
-        model.eval()
+    # try:
+    #     model_config = jsonpickle.decode(open(model_config_path, "r").read())
+    # except:
+    #     print("Model {} config is missing, skip to next model".format(model_config))
+    #     continue
 
-        # try:
-        #     model_config = jsonpickle.decode(open(model_config_path, "r").read())
-        # except:
-        #     print("Model {} config is missing, skip to next model".format(model_config))
-        #     continue
+    # read the gt file, which is a csv with one value in it
+    with open(gt_file, 'r') as f:
+        gt = f.read()
+    f.close()
 
-        # read the gt file, which is a csv with one value in it
-        with open(gt_file, 'r') as f:
-            gt = f.read()
-        f.close()
+    # else:
+    #     gt = ('final_triggered_data_n_total' in model_config.keys())
 
-        # else:
-        #     gt = ('final_triggered_data_n_total' in model_config.keys())
+    img_c = None
+    total_examples = 1 # Default to be a blank image if USE_EXAMPLE=False
+    # If use_examples then read in clean input example images
+    if USE_EXAMPLE and os.path.exists(model_train_example_config):
+        img_c = defaultdict(list)
+        example_file = pd.read_csv(model_train_example_config)
+        example_file.sample(frac=1) # this just shuffles
 
-        gt_list.append(gt)
+        n_classes = len(example_file['true_label'].unique())
 
-        # gt_list.append(gt)
+        for ind in range(example_file.shape[0]):
 
-        img_c = None
-        total_examples = 1 # Default to be a blank image if USE_EXAMPLE=False
-        # If use_examples then read in clean input example images
-        if USE_EXAMPLE and os.path.exists(model_train_example_config):
-            img_c = defaultdict(list)
-            example_file = pd.read_csv(model_train_example_config)
-            example_file.sample(frac=1) # this just shuffles
+            # if example_file['triggered'].iloc[ind]:
+            #     continue
 
-            n_classes = len(example_file['true_label'].unique())
+            c = example_file['true_label'].iloc[ind]
 
-            for ind in range(example_file.shape[0]):
+            if not len(img_c[c]):
+                logging.info(f"Extracting images for class {c}")
+                img_file=glob.glob(
+                        os.path.join(
+                            root,
+                            model_name,
+                            '**',
+                            example_file['file'].iloc[ind]
+                            ),
+                    recursive=True)[0]
 
-                # if example_file['triggered'].iloc[ind]:
-                #     continue
+                img = torch.from_numpy(cv2.imread(img_file, cv2.IMREAD_UNCHANGED)).float()
+                img_c[c].append(img.permute(2,0,1).unsqueeze(0))
 
-                c = example_file['true_label'].iloc[ind]
+            total_examples = sum([len(img_c[c]) for c in img_c])
 
-                if not len(img_c[c]):
-                    logging.info(f"Extracting images for class {c}")
-                    img_file=glob.glob(
-                            os.path.join(
-                                root,
-                                model_name,
-                                '**',
-                                example_file['file'].iloc[ind]
-                                ),
-                        recursive=True)[0]
+            if len(img_c.keys()) == n_classes and total_examples == n_classes:
+                break
 
-                    img = torch.from_numpy(cv2.imread(img_file, cv2.IMREAD_UNCHANGED)).float()
-                    img_c[c].append(img.permute(2,0,1).unsqueeze(0))
+    # model_file_path_prefix = '/'.join(model_file_path.split('/')[:-1])
+    # save_file_path = os.path.join(model_file_path_prefix, 'test_extracted_psf_topo_feature.pkl')
 
-                total_examples = sum([len(img_c[c]) for c in img_c])
+    return {'model_name': model_name, 'arch': model_stats["name"], 'save_file_dir': save_file_dir,
+            'model': model, 'gt': gt, 'img_c': img_c}
 
-                if len(img_c.keys()) == n_classes and total_examples == n_classes:
-                    break
 
-        # model_file_path_prefix = '/'.join(model_file_path.split('/')[:-1])
-        # save_file_path = os.path.join(model_file_path_prefix, 'test_extracted_psf_topo_feature.pkl')
+# def process_model(j, model_list, gt_list, fv_list, gt_list_lock, fv_list_lock, root, device, psf_config):
+def process_model(args):
+    try:
+        j, model_list, gt_list, fv_list, root, device, psf_config = args
+        model_name = model_list[j]
 
+        loaded = load_model(j, model_list, root, device)
+        if loaded is None:
+            return
+        gt_list.append(loaded['gt'])
 
-        fv = topo_psf_feature_extract(model, img_c, psf_config, cache_dir=save_file_dir)
-        with open(save_file_path, 'wb') as f:
+        fv = topo_psf_feature_extract(loaded['model'], loaded['img_c'], psf_config, cache_dir=loaded['save_file_dir'])
+        with open(os.path.join(loaded['save_file_dir'], "fv.pkl"), 'wb') as f:
             pkl.dump(fv, f)
         f.close()
 
@@ -197,6 +236,41 @@ def process_model(args):
         # Optionally return an error message or status
 
 
+def process_model_group(args):
+    """
+    Extract features of a group of models with one stacked forward per probe batch. Models are bucketed by
+    architecture and class-example keys, every bucket is processed MODEL_BATCH models at a time.
+    """
+    try:
+        group, model_list, gt_list, fv_list, root, device, psf_config = args
+
+        buckets = defaultdict(list)
+        for j in group:
+            loaded = load_model(j, model_list, root, device)
+            if loaded is None:
+                continue
+            if loaded['img_c'] is None:
+                # Models without clean examples go alone through the single model path
+                buckets[(loaded['arch'], j)].append(loaded)
+            else:
+                buckets[(loaded['arch'], tuple(sorted(loaded['img_c'])))].append(loaded)
+
+        for bucket in buckets.values():
+            for i in range(0, len(bucket), MODEL_BATCH):
+                chunk = bucket[i:i+MODEL_BATCH]
+                fvs = topo_psf_feature_extract_multi([x['model'] for x in chunk], [x['img_c'] for x in chunk],
+                                                     psf_config, cache_dirs=[x['save_file_dir'] for x in chunk])
+                for loaded, fv in zip(chunk, fvs):
+                    with open(os.path.join(loaded['save_file_dir'], "fv.pkl"), 'wb') as f:
+                        pkl.dump(fv, f)
+                    f.close()
+                    gt_list.append(loaded['gt'])
+                    fv_list.append(fv)
+
+    except Exception as e:
+        logging.error(f"Error processing model group {[model_list[j] for j in group]}: {e}")
+
+
 def main(args):
 
     multiprocessing.set_start_method('spawn', force=True)
@@ -223,6 +297,26 @@ def main(args):
     psf_config['input_range'] = INPUT_RANGE
     psf_config['n_neuron'] = N_SAMPLE_NEURONS
     psf_config['corr_method'] = CORR_METRIC
+    psf_config['corr_methods'] = CORR_METHODS
+    psf_config['probe_mem_mb'] = PROBE_MEM_MB
+    psf_config['incremental'] = INCREMENTAL
+    psf_config['act_reducer'] = ACT_REDUCER
+    psf_config['layer_select'] = LAYER_SELECT
+    psf_config['precision'] = PRECISION
+    psf_config['compile'] = COMPILE
+    psf_config['scan'] = SCAN
+    psf_config['stim_search'] = STIM_SEARCH
+    psf_config['scan_order'] = SCAN_ORDER
+    psf_config['time_budget'] = TIME_BUDGET
+    psf_config['dcor_mem_mb'] = DCOR_MEM_MB
+    psf_config['corr_threads'] = CORR_THREADS
+    psf_config['sketch_tol'] = SKETCH_TOL
+    psf_config['greedy_cutoff'] = GREEDY_CUTOFF
+    psf_config['maxdim'] = MAXDIM
+    psf_config['filtration'] = FILTRATION
+    psf_config['ph_time_budget'] = PH_TIME_BUDGET
+    psf_config['ph_workers'] = PH_WORKERS
+    psf_config['ph_queue_depth'] = PH_QUEUE_DEPTH
     psf_config['device'] = device
 
     root = args.data_root
@@ -241,10 +335,19 @@ def main(args):
     gt_list = manager.list()
     fv_list = manager.list()
 
-    params = [(j, model_list, gt_list, fv_list, root, device, psf_config) for j in range(len(model_list))]
+    if MODEL_BATCH > 1:
+        # Every worker gets a strided share of the models and stacks the same-architecture ones
+        n_group = max(1, min(multiprocessing.cpu_count(), len(model_list)//MODEL_BATCH))
+        groups = [list(range(len(model_list)))[g::n_group] for g in range(n_group)]
+        params = [(g, model_list, gt_list, fv_list, root, device, psf_config) for g in groups]
+        # Non-daemonic workers, they may start their own persistent homology workers (PH_WORKERS)
+        with ProcessPoolExecutor(max_workers=n_group) as pool:
+            results = list(tqdm(pool.map(process_model_group, params), total=len(groups)))
+    else:
+        params = [(j, model_list, gt_list, fv_list, root, device, psf_config) for j in range(len(model_list))]
 
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        results = list(tqdm(pool.imap(process_model, params), total=len(model_list)))
+        with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as pool:
+            results = list(tqdm(pool.map(process_model, params), total=len(model_list)))
 
     # Check results for errors if your function returns status messages
     errors = [res for res in results if res is not None]
@@ -276,6 +379,8 @@ def main(args):
 
     # --------------------------------- Step II: Train Classifier ---------------------------------
     print(">>> Step II: Train Classifier <<<")
+    # Time-budgeted extraction may leave positions uncovered
+    fv_list=[fill_uncovered(fv) for fv in fv_list]
     if CLASSIFIER=='xgboost':
 
         # PSF feature shape = N*2*m*w*h*L*C
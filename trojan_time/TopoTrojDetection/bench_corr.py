@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Crossover benchmark of the distance correlation implementations. For n random neuron traces and every feature
+dimension d, time mat_discorr_adjacency (dense, blockwise past the memory cap), mat_discorr_fast_adjacency and
+mat_discorr_sketch_adjacency, and report the largest difference of the fast result and the true and estimated root
+mean square error of the sketch. With --metrics, time the given metrics of topo_utils.CORR_METRICS instead.
+
+    python bench_corr.py --n 200 --d 4 16 64 256 1024
+    python bench_corr.py --n 1500 --d 4 32 --metrics distcorr cos pearson --threads 4
+"""
+
+import argparse
+import time
+
+import torch
+
+from topo_utils import CORR_METRICS, DCOR_MEM_MB, SKETCH_TOL, mat_discorr_adjacency, mat_discorr_fast_adjacency, mat_discorr_sketch_adjacency
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time()-start
+
+
+def bench_metrics(args):
+    config = {'dcor_mem_mb': args.dcor_mem_mb, 'sketch_tol': args.sketch_tol, 'corr_threads': args.threads}
+    print(f"{'d':>6} "+" ".join(f"{name+' (s)':>18}" for name in args.metrics))
+    for d in args.d:
+        X = torch.randn(args.n, d)
+        times = [timed(CORR_METRICS[name].compute, X, dict(config, corr_method=name))[1] for name in args.metrics]
+        print(f"{d:>6} "+" ".join(f"{t:>18.3f}" for t in times))
+
+
+def main(args):
+    torch.manual_seed(0)
+    if args.metrics:
+        return bench_metrics(args)
+    print(f"{'d':>6} {'distcorr (s)':>14} {'distcorr_fast (s)':>18} {'max abs diff':>14} {'distcorr_sketch (s)':>20} {'rmse':>8} {'rmse est':>9}")
+    off = ~torch.eye(args.n, dtype=torch.bool)
+    for d in args.d:
+        X = torch.randn(args.n, d)
+        ref, t_ref = timed(mat_discorr_adjacency, X, max_mem_mb=args.dcor_mem_mb)
+        fast, t_fast = timed(mat_discorr_fast_adjacency, X, n_threads=args.threads)
+        (sketch, error), t_sketch = timed(mat_discorr_sketch_adjacency, X, args.sketch_tol, return_error=True)
+        rmse = (ref-sketch)[off].pow(2).mean().sqrt().item()
+        print(f"{d:>6} {t_ref:>14.3f} {t_fast:>18.3f} {(ref-fast).abs().max().item():>14.2e} {t_sketch:>20.3f} {rmse:>8.4f} {error['rmse']:>9.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distance correlation crossover benchmark')
+    parser.add_argument('--n', type=int, default=200, help='number of neurons')
+    parser.add_argument('--d', type=int, nargs='+', default=[4, 16, 64, 256, 1024], help='feature dimensions')
+    parser.add_argument('--threads', type=int, default=None, help='threads of the correlation metrics')
+    parser.add_argument('--metrics', type=str, nargs='+', choices=list(CORR_METRICS), default=None, help='metrics to time')
+    parser.add_argument('--dcor_mem_mb', type=int, default=DCOR_MEM_MB, help='memory cap of mat_discorr_adjacency')
+    parser.add_argument('--sketch_tol', type=float, default=SKETCH_TOL, help='target error of mat_discorr_sketch_adjacency')
+    main(parser.parse_args())
@@ -3,13 +3,13 @@ import time
 from collections import defaultdict
 from typing import Dict, List
 
-from ripser import Rips
+from ripser import ripser
 import numpy as np
 import torch
 # from topological_feature_extractor import topo_psf_feature_extract
 from topo_utils import mat_bc_adjacency, parse_arch, feature_collect, sample_act, mat_discorr_adjacency, mat_cos_adjacency, mat_jsdiv_adjacency, mat_pearson_adjacency
 
-from topological_feature_extractor import getGreedyPerm, makeSparseDM, getApproxSparseDM, calc_topo_feature
+from topological_feature_extractor import getGreedyPerm, makeSparseDM, getApproxSparseDM, calc_topo_feature, plan_filtration
 
 
 def modified_topo_psf_feature_extract(model: torch.nn.Module, example_dict: Dict, psf_config: Dict)-> Dict:
@@ -64,7 +64,7 @@ def modified_topo_psf_feature_extract(model: torch.nn.Module, example_dict: Dict
 
     PH_list=[]
     PD_list=[]
-    rips = Rips(verbose=False)
+    filtration_plan=None
     model=model.to(device)
     progress=0
     # For each class input examples, scan through pixels with step_size and modify corresponding pixel with different stimulation level.
@@ -136,13 +136,13 @@ def modified_topo_psf_feature_extract(model: torch.nn.Module, example_dict: Dict
                 D=1-neural_pd.detach().cpu().numpy() if method!='bc' else -np.log(neural_pd.detach().cpu().numpy()+1e-6)
                 PD_list.append(neural_pd.detach().cpu().numpy())
 
-                # Approaximate sparse filtration to further save some computation
-                if model._get_name=='ModdedLeNet5Net':
-                    PH=rips.fit_transform(D, distance_matrix=True)
-                else:
+                # Approaximate sparse filtration to further save some computation, planned at the first position
+                if filtration_plan is None:
+                    filtration_plan=plan_filtration(D, psf_config)
+                if filtration_plan['filtration']=='sparse':
                     lambdas=getGreedyPerm(D)
-                    D = getApproxSparseDM(lambdas, 0.1, D)
-                    PH=rips.fit_transform(D, distance_matrix=True)
+                    D = getApproxSparseDM(lambdas, filtration_plan['eps'], D)
+                PH=ripser(D, thresh=filtration_plan['thresh'], distance_matrix=True)['dgms']
 
                 PH[0]=np.array(PH[0])
                 PH[1]=np.array(PH[1])
@@ -0,0 +1,1008 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import copy
+import itertools
+import logging
+import operator
+import time
+import warnings
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import torch
+import torch.fx as fx
+import torch.nn.functional as F
+import torch.utils.data as data
+from torch.nn.modules.utils import _pair
+import numpy as np
+
+from topo_utils import ACT_REDUCERS, ActivationRecorder, GraphFeatureExtractor, get_act_reducer, parse_arch, select_layers
+
+# Default memory budget (in MB) for one batch of PSF probes
+PROBE_MEM_MB = 1024
+# Upper bound on the number of probes forwarded together
+MAX_PROBE_BATCH = 512
+# Numerical precision of the probe forwards: fp32, bf16 autocast, or int8 dynamic quantization of Linear layers
+PRECISIONS = ('fp32', 'bf16', 'int8')
+# Backends compiling the probe graph: TorchScript trace or torch.compile (inductor)
+COMPILE_BACKENDS = ('jit', 'inductor')
+# Compiled probe graphs shared by the models of one architecture, see CompiledFeatureExtractor
+COMPILED_GRAPHS = {}
+# Adaptive stimulation search: levels probed first, response change below which a level interval is interpolated,
+# and number of positions searched together
+STIM_INIT = 3
+STIM_TOL = 0.05
+STIM_CHUNK = 64
+
+
+def quantize_int8(model: torch.nn.Module)-> Tuple[torch.nn.Module, Tuple]:
+    """
+    Dynamically quantized (int8 weights, activations quantized on the fly) copy of model. Only Linear layers have a
+    dynamic int8 kernel, Conv2d layers stay in fp32. Runs on cpu only.
+    Return:
+        qmodel (torch.nn.Module): quantized copy, model itself is left untouched
+        layer_list (Tuple): parse_arch of model mapped to the modules of qmodel, the quantized Linear layers are not
+            torch.nn.Linear anymore
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        qmodel = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    module_names = {id(m): n for n, m in model.named_modules()}
+    layer_list, layer_k = parse_arch(model)
+    return qmodel, ([qmodel.get_submodule(module_names[id(m)]) for m in layer_list], layer_k)
+
+
+@dataclass
+class ProbeJob:
+    """
+    All stimulation probes of one class example at one spatial position.
+        c (int): key of the class example in example_dict
+        pos_ind (int): flattened index of the position in the PSF feature map
+        pos_w (int): row of the top-left corner of the stimulation patch
+        pos_h (int): column of the top-left corner of the stimulation patch
+        stim_seq (np.array): stimulation levels written into the patch
+    """
+    c: int
+    pos_ind: int
+    pos_w: int
+    pos_h: int
+    stim_seq: np.ndarray
+
+
+def is_oom_error(e: BaseException)-> bool:
+    """
+    Check whether an exception raised during forward is an allocation failure (CUDA, MPS or CPU allocator).
+    """
+    if isinstance(e, MemoryError):
+        return True
+    msg = str(e).lower()
+    return isinstance(e, RuntimeError) and ("out of memory" in msg or "can't allocate memory" in msg)
+
+
+class PSFProbeDataset(data.IterableDataset):
+    """
+    Lazily synthesize PSF probe batches on the target device. Every probe is built by broadcasting its class example
+    against a patch mask and a stimulation level, so no probe tensor is ever held in host memory. Already batched, so
+    use it with DataLoader(dataset, batch_size=None) in the main process.
+    Input args:
+        example_dict (Dict): dictionary of clean input examples, example_dict[c][0] is a 1*C*H*W tensor
+        jobs (Iterable): ProbeJob to be synthesized, may be a lazy generator
+        patch_size (int): size of the stimulation patch
+        device (torch.device): device on which the probes are built
+        batch_size (int): number of probes per batch, read again before every batch so it can be changed on the fly
+    Yield:
+        probes (List): (job index, stimulation index, job) of every probe in the batch
+        prob_input (torch.tensor): B*C*H*W probe batch on device
+    """
+
+    def __init__(self, example_dict: Dict, jobs: Iterable[ProbeJob], patch_size: int, device: torch.device, batch_size: int):
+        super(PSFProbeDataset, self).__init__()
+        self.class_ind = {c: i for i, c in enumerate(example_dict)}
+        self.base = torch.cat([example_dict[c][0] for c in example_dict]).to(device)
+        self.jobs = jobs
+        self.patch_size = patch_size
+        self.device = device
+        self.batch_size = batch_size
+
+    def synthesize(self, probes: List[Tuple[int, int, ProbeJob]])-> torch.tensor:
+        """
+        Build the probe batch on device: probe = stim if inside the patch else the clean example.
+        """
+        ind = torch.tensor([self.class_ind[job.c] for _, _, job in probes], device=self.device)
+        pos = torch.tensor([[job.pos_w, job.pos_h] for _, _, job in probes], device=self.device)
+        stim = torch.tensor([job.stim_seq[s] for _, s, job in probes], dtype=self.base.dtype, device=self.device)
+        rows = torch.arange(self.base.shape[-2], device=self.device)[None, :]
+        cols = torch.arange(self.base.shape[-1], device=self.device)[None, :]
+        row_mask = (rows>=pos[:, :1])&(rows<pos[:, :1]+self.patch_size)
+        col_mask = (cols>=pos[:, 1:])&(cols<pos[:, 1:]+self.patch_size)
+        # Broadcast over the channel dim (and the model dim of stacked examples)
+        extra = (1,)*(self.base.dim()-3)
+        mask = (row_mask[:, :, None]&col_mask[:, None, :]).view((len(probes),)+extra+tuple(self.base.shape[-2:]))
+        return torch.where(mask, stim.view((len(probes),)+extra+(1, 1)), self.base[ind])
+
+    def __iter__(self)-> Iterator[Tuple[List, torch.tensor]]:
+        probes = []
+        for j, job in enumerate(self.jobs):
+            for s in range(len(job.stim_seq)):
+                probes.append((j, s, job))
+                if len(probes)>=self.batch_size:
+                    yield probes, self.synthesize(probes)
+                    probes = []
+        if probes:
+            yield probes, self.synthesize(probes)
+
+
+class StackedProbeDataset(PSFProbeDataset):
+    """
+    PSFProbeDataset for K models probed together. Every model has its own class examples, the probes of one batch
+    share their positions and stimulation levels.
+    Input args:
+        example_dicts (List): example_dict of every model, all with the same class keys
+        (others as PSFProbeDataset)
+    Yield:
+        probes (List): (job index, stimulation index, job) of every probe in the batch
+        prob_input (torch.tensor): B*K*C*H*W probe batch on device
+    """
+
+    def __init__(self, example_dicts: List[Dict], jobs: Iterable[ProbeJob], patch_size: int, device: torch.device, batch_size: int):
+        super(StackedProbeDataset, self).__init__(example_dicts[0], jobs, patch_size, device, batch_size)
+        self.base = torch.stack([torch.cat([x[c][0] for x in example_dicts]) for c in example_dicts[0]]).to(device)
+
+
+class CompiledFeatureExtractor(GraphFeatureExtractor):
+    """
+    GraphFeatureExtractor whose truncated graph is compiled once per architecture, input shape and layer selection and
+    kept in COMPILED_GRAPHS. The next model of the same architecture only swaps its weights into the compiled graph:
+    'jit' copies them into the traced module, 'inductor' passes them as inputs of a compiled functional_call.
+    Input args:
+        model (torch.nn.Module): target model
+        example_input (torch.tensor): probe batch used to trace and warm up the graph
+        backend (str): one of COMPILE_BACKENDS
+        (others as GraphFeatureExtractor)
+    """
+
+    def __init__(self, model: torch.nn.Module, example_input: torch.tensor, backend: str, layer_ind: List,
+                 keep_output: bool = True, reducer=None, channels: Dict = None):
+        super(CompiledFeatureExtractor, self).__init__(model, layer_ind, keep_output, reducer, channels)
+        if backend not in COMPILE_BACKENDS:
+            raise Exception(f"Unknown compile backend {backend}, choose from {COMPILE_BACKENDS}")
+        self.backend = backend
+        start = time.time()
+        state = self.gm.state_dict()
+        key = (backend, type(model).__module__, type(model).__qualname__, tuple((k, tuple(v.shape)) for k, v in state.items()),
+               tuple(example_input.shape[1:]), tuple(self.layer_ind), keep_output)
+        self.reused = key in COMPILED_GRAPHS
+        if not self.reused:
+            if backend=='jit':
+                with torch.no_grad():
+                    COMPILED_GRAPHS[key] = torch.jit.trace(self.gm, example_input, check_trace=False, strict=False)
+            else:
+                template = self.gm
+                def functional_forward(params, buffers, x):
+                    return torch.func.functional_call(template, (params, buffers), (x,))
+                COMPILED_GRAPHS[key] = torch.compile(functional_forward)
+        self.compiled = COMPILED_GRAPHS[key]
+        if backend=='jit':
+            self.compiled.load_state_dict(state, strict=False)
+        else:
+            # Plain tensors, so that the graph does not specialize on the Parameter objects of one model
+            self.params = {k: v.detach() for k, v in self.gm.named_parameters()}
+            self.buffers = {k: v.detach() for k, v in self.gm.named_buffers()}
+        # The first call pays for the optimization passes / code generation of the compiled graph
+        with torch.no_grad():
+            self.run(example_input)
+        self.warmup_time = time.time()-start
+        logging.info(f"{'reused' if self.reused else 'compiled'} {backend} probe graph of {model._get_name()}, warm-up {self.warmup_time:.2f}s")
+
+    def run(self, images: torch.tensor)-> Tuple:
+        if self.backend=='jit':
+            return self.compiled(images)
+        return self.compiled(self.params, self.buffers, images)
+
+
+# Modules, functions and methods that act on every spatial location independently
+ELEMENTWISE_MODULES = (torch.nn.ReLU, torch.nn.ReLU6, torch.nn.LeakyReLU, torch.nn.PReLU, torch.nn.ELU, torch.nn.SELU,
+                       torch.nn.GELU, torch.nn.SiLU, torch.nn.Sigmoid, torch.nn.Tanh, torch.nn.Hardtanh,
+                       torch.nn.Hardswish, torch.nn.Hardsigmoid, torch.nn.Identity, torch.nn.Dropout, torch.nn.Dropout2d)
+ELEMENTWISE_FUNCTIONS = {torch.relu, torch.sigmoid, torch.tanh, F.relu, F.relu6, F.leaky_relu, F.gelu, F.silu,
+                         F.hardswish, F.dropout}
+ELEMENTWISE_METHODS = {'relu', 'sigmoid', 'tanh', 'contiguous', 'clamp'}
+# Binary (or n-ary) ops that combine feature maps location by location
+NARY_FUNCTIONS = {operator.add, operator.sub, operator.mul, operator.truediv, torch.add, torch.sub, torch.mul, torch.cat}
+NARY_METHODS = {'add', 'sub', 'mul'}
+# Reducers that split over disjoint spatial regions: (partial aggregate, combine stacked partials, finish from the
+# aggregate and the number of locations). The others are applied to the materialized layer input
+DECOMPOSABLE_REDUCERS = {
+    'max': (lambda x: x.amax((2, 3)), lambda p: p.amax(0), lambda a, n: a),
+    'mean': (lambda x: x.sum((2, 3)), lambda p: p.sum(0), lambda a, n: a/n),
+    'l2': (lambda x: x.square().sum((2, 3)), lambda p: p.sum(0), lambda a, n: a.sqrt()),
+}
+
+
+class _Clean:
+    """
+    Value identical to the clean forward of the probe's class example.
+    """
+
+
+CLEAN = _Clean()
+
+
+class _Patch:
+    """
+    Batched feature map that equals the clean one except inside region=(r0, r1, c0, c1), whose content is window.
+    """
+    __slots__ = ('region', 'window')
+
+    def __init__(self, region: Tuple, window: torch.tensor):
+        self.region = region
+        self.window = window
+
+
+class _Full:
+    """
+    Fully materialized batched value.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Const:
+    """
+    Value that does not depend on the probes (parameters, python scalars, ...).
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _conv_out_range(a: int, b: int, k: int, s: int, p: int, d: int, out_size: int)-> Tuple[int, int]:
+    """
+    Output rows [o0, o1) of a sliding window op whose receptive field intersects the changed input rows [a, b).
+    """
+    o0 = max(0, -((d*(k-1)-a-p)//s))
+    o1 = min(out_size, (b-1+p)//s+1)
+    return o0, o1
+
+
+def _crop(clean: torch.tensor, ind: torch.tensor, region: Tuple, fill: float)-> torch.tensor:
+    """
+    Crop region of the clean feature maps of the given examples, filling the part outside the map with fill.
+    """
+    r0, r1, c0, c1 = region
+    H, W = clean.shape[2:]
+    out = clean.new_full((len(ind), clean.shape[1], r1-r0, c1-c0), fill)
+    ir0, ir1, ic0, ic1 = max(r0, 0), min(r1, H), max(c0, 0), min(c1, W)
+    if ir0<ir1 and ic0<ic1:
+        out[:, :, ir0-r0:ir1-r0, ic0-c0:ic1-c0] = clean[ind, :, ir0:ir1, ic0:ic1]
+    return out
+
+
+def _overlay(out: torch.tensor, region: Tuple, patch: _Patch)-> torch.tensor:
+    """
+    Write the part of the patch window that falls into region onto out, a crop of that region.
+    """
+    r0, r1, c0, c1 = region
+    p0, p1, q0, q1 = patch.region
+    ir0, ir1, ic0, ic1 = max(r0, p0), min(r1, p1), max(c0, q0), min(c1, q1)
+    if ir0<ir1 and ic0<ic1:
+        out[:, :, ir0-r0:ir1-r0, ic0-c0:ic1-c0] = patch.window[:, :, ir0-p0:ir1-p0, ic0-q0:ic1-q0]
+    return out
+
+
+class IncrementalProbeForward:
+    """
+    Incremental inference for patch perturbations. The clean forward of every class example is cached node by node
+    on the FX graph of the model. A probe then only recomputes the receptive-field region its patch touches through
+    Conv2d, pooling, elementwise and residual ops, and materializes the full map where an op mixes all locations
+    (flatten, Linear, global pooling, ...). Layer inputs of the Conv2d/Linear modules found by parse_arch are reduced
+    like the hook-based path: decomposable reducers (see DECOMPOSABLE_REDUCERS) combine the patch with cached
+    aggregates of the clean map around it, the others run on the materialized layer input.
+    Models in train mode (BatchNorm batch statistics, dropout) or that can not be traced are not supported, in which
+    case self.supported is False and the caller should run the full forward.
+    Input args:
+        model (torch.nn.Module): target model
+        example_dict (Dict): dictionary of clean input examples, example_dict[c][0] is a 1*C*H*W tensor
+        patch_size (int): size of the stimulation patch
+        device (torch.device): device of the model
+        reducer_name (str): name of the activation reducer in ACT_REDUCERS
+        reducer (callable): Optional. The reducer itself, default to ACT_REDUCERS[reducer_name]
+        layer_ind (List): Optional. Indices (into parse_arch) of the recorded layers, default to all
+    """
+
+    def __init__(self, model: torch.nn.Module, example_dict: Dict, patch_size: int, device: torch.device,
+                 reducer_name: str = 'max', reducer=None, layer_ind: List = None):
+        self.model = model
+        self.reducer = reducer if reducer is not None else ACT_REDUCERS[reducer_name]
+        self.decomposed = DECOMPOSABLE_REDUCERS.get(reducer_name)
+        self.patch_size = patch_size
+        self.device = device
+        self.class_ind = {c: i for i, c in enumerate(example_dict)}
+        self.supported = False
+        if any(m.training for m in model.modules()):
+            logging.warning("incremental probing needs the model in eval mode, falling back to full forward")
+            return
+        try:
+            self.gm = fx.symbolic_trace(model)
+        except Exception as e:
+            logging.warning(f"incremental probing can not trace {model._get_name()} ({e}), falling back to full forward")
+            return
+        self.modules = dict(self.gm.named_modules())
+        layer_list = parse_arch(model)[0]
+        layer_ind = range(len(layer_list)) if layer_ind is None else layer_ind
+        self.hooked = {id(layer_list[i]) for i in layer_ind}
+        self.n_layers = len(layer_ind)
+        # Cache the clean output of every node for all class examples at once
+        self.cache = {}
+        self.clean_act = {}
+        base = torch.cat([example_dict[c][0] for c in example_dict]).to(device)
+        with torch.no_grad():
+            _CleanRecorder(self.gm, self.cache).run(base)
+        for node, value in self.cache.items():
+            if isinstance(value, torch.Tensor) and value.dim()==4:
+                self.clean_act[node] = self.reducer(value)
+        self.supported = True
+
+    def forward(self, probes: List, prob_input: torch.tensor)-> Tuple[torch.tensor, List]:
+        """
+        Forward a probe batch incrementally, probes sharing a patch position are run together.
+        Input args:
+            probes (List): (job index, stimulation index, job) of every probe in the batch
+            prob_input (torch.tensor): B*C*H*W probe batch
+        Return:
+            output (torch.tensor): B*C logits on cpu
+            layer_act (List): list of n_l*B activation matrices, one per Conv2d/Linear layer
+        """
+        H, W = prob_input.shape[2:]
+        groups = defaultdict(list)
+        for b, (_, _, job) in enumerate(probes):
+            groups[(job.pos_w, job.pos_h)].append(b)
+        output, layer_act = None, None
+        with torch.no_grad():
+            for (pos_w, pos_h), b_list in groups.items():
+                b_ind = torch.tensor(b_list, device=prob_input.device)
+                cls = torch.tensor([self.class_ind[probes[b][2].c] for b in b_list], device=self.device)
+                region = (pos_w, min(pos_w+self.patch_size, H), pos_h, min(pos_h+self.patch_size, W))
+                window = prob_input[b_ind][:, :, region[0]:region[1], region[2]:region[3]]
+                out, acts = self._run_graph(cls, _Patch(region, window))
+                if output is None:
+                    output = out.new_zeros((len(probes),)+tuple(out.shape[1:]))
+                    layer_act = [x.new_zeros((len(probes),)+tuple(x.shape[1:])) for x in acts]
+                output[b_ind] = out
+                for l in range(len(acts)):
+                    layer_act[l][b_ind] = acts[l]
+        return output.detach().cpu(), [x.T.cpu() for x in layer_act]
+
+    def verify(self, result: Tuple[torch.tensor, List], reference: Tuple[torch.tensor, List], tol: float):
+        """
+        Compare the incremental result with the full forward one and raise if they differ by more than tol (relative
+        to the magnitude of the reference).
+        """
+        pairs = [('output', result[0], reference[0])]+[(f'layer {l}', x, y) for l, (x, y) in enumerate(zip(result[1], reference[1]))]
+        if len(result[1])!=len(reference[1]):
+            raise Exception(f"incremental forward recorded {len(result[1])} layers, full forward {len(reference[1])}")
+        for name, x, y in pairs:
+            err = (x-y).abs().max().item()
+            if err>tol*(1+y.abs().max().item()):
+                raise Exception(f"incremental forward differs from full forward at {name}: max abs error {err:.3e}")
+
+    def _run_graph(self, cls: torch.tensor, patch: _Patch)-> Tuple[torch.tensor, List]:
+        env = {}
+        records = []
+        for node in self.gm.graph.nodes:
+            if node.op=='placeholder':
+                env[node] = patch
+            elif node.op=='get_attr':
+                attr = self.gm
+                for name in node.target.split('.'):
+                    attr = getattr(attr, name)
+                env[node] = _Const(attr)
+            elif node.op=='output':
+                return self._materialize_arg(node.args[0], env, cls), records[:self.n_layers]
+            else:
+                env[node] = self._run_node(node, env, cls, records)
+
+    def _materialize(self, node: fx.Node, state, cls: torch.tensor):
+        if isinstance(state, (_Full, _Const)):
+            return state.value
+        full = self.cache[node][cls]
+        if isinstance(state, _Patch):
+            r0, r1, c0, c1 = state.region
+            full[:, :, r0:r1, c0:c1] = state.window
+        return full
+
+    def _materialize_arg(self, arg, env: Dict, cls: torch.tensor):
+        return fx.node.map_arg(arg, lambda n: self._materialize(n, env[n], cls))
+
+    def _window(self, node: fx.Node, state, cls: torch.tensor, region: Tuple, fill: float)-> torch.tensor:
+        out = _crop(self.cache[node], cls, region, fill)
+        return _overlay(out, region, state) if isinstance(state, _Patch) else out
+
+    def _to_state(self, node: fx.Node, region: Tuple, window: torch.tensor):
+        H, W = self.cache[node].shape[2:]
+        if region==(0, H, 0, W):
+            return _Full(window)
+        return _Patch(region, window)
+
+    def _record(self, node: fx.Node, state, cls: torch.tensor)-> torch.tensor:
+        """
+        Reduced activation of the input of a hooked layer.
+        """
+        if isinstance(state, _Full):
+            x = state.value
+            return self.reducer(x) if x.dim()==4 else x
+        clean = self.cache[node]
+        if clean.dim()!=4:
+            return clean[cls]
+        if state is CLEAN:
+            return self.clean_act[node][cls]
+        if self.decomposed is None:
+            return self.reducer(self._materialize(node, state, cls))
+        # Aggregate of the clean map outside the patch region, taken from the (up to) four strips around it
+        partial, combine, finish = self.decomposed
+        r0, r1, c0, c1 = state.region
+        H, W = clean.shape[2:]
+        parts = [partial(state.window)]
+        strips = [clean[:, :, :r0], clean[:, :, r1:], clean[:, :, r0:r1, :c0], clean[:, :, r0:r1, c1:]]
+        for strip in strips:
+            if strip.numel():
+                parts.append(partial(strip)[cls])
+        return finish(combine(torch.stack(parts)), H*W)
+
+    def _call(self, node: fx.Node, args: Tuple, kwargs: Dict):
+        if node.op=='call_module':
+            return self.modules[node.target](*args, **kwargs)
+        if node.op=='call_function':
+            return node.target(*args, **kwargs)
+        return getattr(args[0], node.target)(*args[1:], **kwargs)
+
+    def _run_node(self, node: fx.Node, env: Dict, cls: torch.tensor, records: List):
+        inputs = node.all_input_nodes
+        batched = [n for n in inputs if not isinstance(env[n], _Const)]
+        if node.op=='call_module' and id(self.modules[node.target]) in self.hooked:
+            records.append(self._record(node.args[0], env[node.args[0]], cls))
+        # Nothing depends on the probes
+        if not batched:
+            args, kwargs = fx.node.map_arg((node.args, node.kwargs), lambda n: env[n].value)
+            return _Const(self._call(node, args, kwargs))
+        # Shape queries on feature maps that are not materialized
+        x = node.args[0] if node.args else None
+        if isinstance(x, fx.Node) and not isinstance(env[x], (_Full, _Const)):
+            shape = torch.Size((len(cls),)+tuple(self.cache[x].shape[1:]))
+            if node.op=='call_method' and node.target=='size':
+                dim = node.args[1] if len(node.args)>1 else node.kwargs.get('dim')
+                return _Const(shape if dim is None else shape[dim])
+            if node.op=='call_method' and node.target=='dim':
+                return _Const(len(shape))
+            if node.op=='call_function' and node.target is getattr and node.args[1]=='shape':
+                return _Const(shape)
+        states = [env[n] for n in batched]
+        is_tensor = isinstance(self.cache.get(node), torch.Tensor)
+        if is_tensor and all(s is CLEAN for s in states):
+            return CLEAN
+        if is_tensor and self.cache[node].dim()==4 and not any(isinstance(s, _Full) for s in states):
+            state = self._run_patch(node, env, cls)
+            if state is not None:
+                return state
+        # Fall back to full computation of this node
+        args, kwargs = self._materialize_arg((node.args, node.kwargs), env, cls)
+        out = self._call(node, args, kwargs)
+        return _Full(out) if isinstance(out, torch.Tensor) else _Const(out)
+
+    def _run_patch(self, node: fx.Node, env: Dict, cls: torch.tensor):
+        """
+        Propagate the patch through node. Return None if it can not be done exactly.
+        """
+        x = node.args[0] if node.args else None
+        single = isinstance(x, fx.Node) and isinstance(env[x], _Patch) and \
+            all(isinstance(env[n], _Const) for n in node.all_input_nodes if n is not x)
+        if node.op=='call_module':
+            module = self.modules[node.target]
+            if not single:
+                return None
+            if isinstance(module, ELEMENTWISE_MODULES) or \
+                    (isinstance(module, torch.nn.BatchNorm2d) and module.running_mean is not None):
+                args, kwargs = fx.node.map_arg((node.args[1:], node.kwargs), lambda n: env[n].value)
+                return _Patch(env[x].region, module(env[x].window, *args, **kwargs))
+            if isinstance(module, torch.nn.Conv2d) and module.padding_mode=='zeros' and not isinstance(module.padding, str):
+                def op(w): return F.conv2d(w, module.weight, module.bias, module.stride, 0, module.dilation, module.groups)
+                return self._run_window(node, x, env, cls, op, module.kernel_size, module.stride, module.padding, module.dilation, 0.)
+            if isinstance(module, torch.nn.MaxPool2d) and not module.ceil_mode and not module.return_indices:
+                k, d = _pair(module.kernel_size), _pair(module.dilation)
+                s = _pair(module.stride if module.stride is not None else module.kernel_size)
+                def op(w): return F.max_pool2d(w, k, s, 0, d)
+                return self._run_window(node, x, env, cls, op, k, s, _pair(module.padding), d, -float('inf'))
+            if isinstance(module, torch.nn.AvgPool2d) and not module.ceil_mode and \
+                    (module.count_include_pad or module.padding==0):
+                k = _pair(module.kernel_size)
+                s = _pair(module.stride if module.stride is not None else module.kernel_size)
+                def op(w): return F.avg_pool2d(w, k, s, 0, False, True, module.divisor_override)
+                return self._run_window(node, x, env, cls, op, k, s, _pair(module.padding), (1, 1), 0.)
+            return None
+        if single and ((node.op=='call_function' and node.target in ELEMENTWISE_FUNCTIONS) or
+                       (node.op=='call_method' and node.target in ELEMENTWISE_METHODS)):
+            args, kwargs = fx.node.map_arg((node.args[1:], node.kwargs), lambda n: env[n].value)
+            return _Patch(env[x].region, self._call(node, (env[x].window,)+tuple(args), kwargs))
+        if (node.op=='call_function' and node.target in NARY_FUNCTIONS) or \
+                (node.op=='call_method' and node.target in NARY_METHODS):
+            return self._run_nary(node, env, cls)
+        return None
+
+    def _run_window(self, node, x, env, cls, op, k, s, p, d, fill):
+        """
+        Recompute the output region of a sliding window op (conv or pooling) touched by the patch of its input.
+        """
+        a0, a1, b0, b1 = env[x].region
+        H, W = self.cache[node].shape[2:]
+        o0, o1 = _conv_out_range(a0, a1, k[0], s[0], p[0], d[0], H)
+        q0, q1 = _conv_out_range(b0, b1, k[1], s[1], p[1], d[1], W)
+        if o0>=o1 or q0>=q1:
+            return CLEAN
+        in_region = (o0*s[0]-p[0], (o1-1)*s[0]-p[0]+d[0]*(k[0]-1)+1, q0*s[1]-p[1], (q1-1)*s[1]-p[1]+d[1]*(k[1]-1)+1)
+        window = self._window(x, env[x], cls, in_region, fill)
+        return self._to_state(node, (o0, o1, q0, q1), op(window))
+
+    def _run_nary(self, node: fx.Node, env: Dict, cls: torch.tensor):
+        if node.target is torch.cat:
+            dim = node.args[1] if len(node.args)>1 else node.kwargs.get('dim', 0)
+            if dim not in (1, -3):
+                return None
+        out_shape = self.cache[node].shape[2:]
+        patches = [env[n].region for n in node.all_input_nodes if isinstance(env[n], _Patch)]
+        for n in node.all_input_nodes:
+            if isinstance(env[n], _Const):
+                continue
+            shape = self.cache[n].shape
+            if len(shape)!=4 or (shape[2:]!=out_shape and (isinstance(env[n], _Patch) or tuple(shape[2:])!=(1, 1))):
+                return None
+        region = (min(r[0] for r in patches), max(r[1] for r in patches), min(r[2] for r in patches), max(r[3] for r in patches))
+        def window(n):
+            if isinstance(env[n], _Const):
+                return env[n].value
+            if self.cache[n].shape[2:]!=out_shape:
+                return self.cache[n][cls]
+            return self._window(n, env[n], cls, region, 0.)
+        args, kwargs = fx.node.map_arg((node.args, node.kwargs), window)
+        return self._to_state(node, region, self._call(node, args, kwargs))
+
+
+class _CleanRecorder(fx.Interpreter):
+    """
+    Run the traced graph and keep a copy of the output of every node.
+    """
+
+    def __init__(self, gm: fx.GraphModule, cache: Dict):
+        super(_CleanRecorder, self).__init__(gm)
+        self.cache = cache
+
+    def run_node(self, n: fx.Node):
+        out = super(_CleanRecorder, self).run_node(n)
+        if n.op!='get_attr':
+            self.cache[n] = out.clone() if isinstance(out, torch.Tensor) else out
+        return out
+
+
+class PSFProbeScheduler:
+    """
+    Pack PSF probes from many positions, stimulation levels and class examples into batches whose size is derived
+    from a memory budget, and scatter the results back per position.
+
+    Input args:
+        model (torch.nn.Module): target model
+        example_dict (Dict): dictionary of clean input examples, example_dict[c][0] is a 1*C*H*W tensor
+        psf_config (Dict): PSF configuration. Optional keys:
+            'probe_mem_mb' (int): memory budget in MB of one probe batch, default PROBE_MEM_MB
+            'max_batch_size' (int): upper bound of the batch size, default MAX_PROBE_BATCH
+            'incremental' (bool): recompute only the receptive field of the patch, see IncrementalProbeForward
+            'incremental_verify' (bool): also run the full forward and check the incremental result against it
+            'incremental_tol' (float): relative tolerance of the check, default 1e-4
+            'act_reducer' (str): spatial reducer of conv layer inputs, applied on device, see topo_utils.ACT_REDUCERS
+            'layer_select' (Dict): layers recorded for the activation graph, see topo_utils.select_layers
+            'activation_only' (bool): skip the logits, the forward stops after the last selected layer. pred then has
+                no class column
+            'precision' (str): precision of the forwards, one of PRECISIONS, default 'fp32'. Incremental inference
+                runs in fp32 only
+            'compile' (str): compile the probe graph with one of COMPILE_BACKENDS and share it between models of the
+                same architecture, see CompiledFeatureExtractor. fp32 full forwards only
+        sample_plan (Dict): Optional. Neuron sampling plan of the model (see topo_utils.make_sample_plan), only the
+            sampled channels are recorded and layers without any are skipped
+    """
+
+    def __init__(self, model: torch.nn.Module, example_dict: Dict, psf_config: Dict, sample_plan: Dict = None):
+        self.model = model
+        self.example_dict = example_dict
+        self.patch_size = psf_config['patch_size']
+        self.device = psf_config['device']
+        self.mem_budget = psf_config.get('probe_mem_mb', PROBE_MEM_MB)*2**20
+        self.max_batch_size = psf_config.get('max_batch_size', MAX_PROBE_BATCH)
+        self.batch_size = None
+        self.verify = psf_config.get('incremental_verify', False)
+        self.verify_tol = psf_config.get('incremental_tol', 1e-4)
+        self.reducer = get_act_reducer(psf_config)
+        self.layer_ind = select_layers(model, psf_config)
+        self.channels = None
+        if sample_plan is not None:
+            self.layer_ind = [i for i, ch in zip(sample_plan['layer_ind'], sample_plan['channels']) if len(ch)]
+            self.channels = {i: torch.as_tensor(ch, dtype=torch.long) for i, ch in zip(sample_plan['layer_ind'], sample_plan['channels']) if len(ch)}
+        self.keep_output = not psf_config.get('activation_only', False)
+        self.precision = psf_config.get('precision', 'fp32')
+        if self.precision not in PRECISIONS:
+            raise Exception(f"Unknown precision {self.precision}, choose from {PRECISIONS}")
+        if self.precision=='int8' and torch.device(self.device).type!='cpu':
+            logging.warning("int8 dynamic quantization runs on cpu only, probing in fp32")
+            self.precision = 'fp32'
+        self.forward_model, self.forward_layers = model, None
+        if self.precision=='int8':
+            self.forward_model, self.forward_layers = quantize_int8(model)
+        self.compile = psf_config.get('compile')
+        if self.compile and self.precision!='fp32':
+            logging.warning(f"compiled probe graphs run in fp32 only, probing {self.precision} eagerly")
+            self.compile = None
+        self.warmup_time = 0.
+        self.recorder = None
+        self.incremental = None
+        if psf_config.get('incremental', False) and self.precision!='fp32':
+            logging.warning(f"incremental probing runs in fp32 only, using full {self.precision} forwards")
+        elif psf_config.get('incremental', False):
+            incremental = IncrementalProbeForward(model, example_dict, self.patch_size, self.device,
+                                                  psf_config.get('act_reducer', 'max'), self.reducer, self.layer_ind)
+            self.incremental = incremental if incremental.supported else None
+
+    def estimate_probe_bytes(self)-> int:
+        """
+        Estimate the memory footprint of a single probe by summing the output size of every leaf module.
+        """
+        nbytes = [0]
+        def size_hook(module, f_in, f_out):
+            if isinstance(f_out, torch.Tensor):
+                nbytes[0] += f_out.numel()*f_out.element_size()
+        handle_list = [m.register_forward_hook(size_hook) for m in self.model.modules() if not m._modules]
+        test_input = next(iter(self.example_dict.values()))[0].to(self.device)
+        with torch.no_grad():
+            self.model(test_input)
+        for handle in handle_list:
+            handle.remove()
+        return nbytes[0]+test_input.numel()*test_input.element_size()
+
+    def estimate_batch_size(self)-> int:
+        probe_bytes = self.estimate_probe_bytes()
+        batch_size = int(min(max(self.mem_budget//max(probe_bytes, 1), 1), self.max_batch_size))
+        logging.info(f"probe scheduler: {probe_bytes/2**20:.2f}MB per probe, batch size {batch_size}")
+        return batch_size
+
+    def make_dataset(self, jobs: Iterable[ProbeJob])-> PSFProbeDataset:
+        return PSFProbeDataset(self.example_dict, jobs, self.patch_size, self.device, self.batch_size)
+
+    def make_recorder(self, prob_input: torch.tensor):
+        """
+        Hooks on the selected layers, or the truncated FX graph when only part of the model is needed or the graph is
+        compiled.
+        """
+        if self.compile:
+            try:
+                recorder = CompiledFeatureExtractor(self.model, prob_input, self.compile, self.layer_ind, self.keep_output, self.reducer, self.channels)
+                self.warmup_time += recorder.warmup_time
+                return recorder
+            except Exception as e:
+                logging.warning(f"can not compile {self.model._get_name()} ({e}), probing eagerly")
+        if len(self.layer_ind)<len(parse_arch(self.model)[0]) or not self.keep_output:
+            try:
+                return GraphFeatureExtractor(self.forward_model, self.layer_ind, self.keep_output, self.reducer, self.channels, self.forward_layers)
+            except Exception as e:
+                logging.warning(f"can not truncate {self.model._get_name()} ({e}), hooking the selected layers instead")
+        return ActivationRecorder(self.forward_model, capacity=len(prob_input), pin_memory=True, reducer=self.reducer, layer_ind=self.layer_ind, channels=self.channels, layer_list=self.forward_layers)
+
+    def close(self):
+        """
+        Remove the recorder hooks and buffers from the model.
+        """
+        if self.recorder is not None and hasattr(self.recorder, 'close'):
+            self.recorder.close()
+        self.recorder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def autocast(self):
+        if self.precision=='bf16':
+            return torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def full_forward(self, prob_input: torch.tensor)-> Tuple[torch.tensor, List]:
+        """
+        Forward a probe batch, the layer inputs are reduced to one value per neuron inside the hooks.
+        Return:
+            output (torch.tensor): B*C logits on cpu
+            layer_act (List): list of n_l*B activation matrices, one per Conv2d/Linear layer
+        """
+        if self.recorder is None:
+            # Hooks and buffers are set up once and reused by every batch
+            self.recorder = self.make_recorder(prob_input)
+        with torch.no_grad(), self.autocast():
+            feature_dict, output = self.recorder.record(prob_input)
+        # Copy out of the recorder buffers, they are overwritten by the next batch
+        layer_act = [feature_dict[k].T.to(torch.float32, copy=True) for k in feature_dict]
+        if output is None:
+            output = prob_input.new_zeros(len(prob_input), 0)
+        return output.detach().float().cpu(), layer_act
+
+    def forward(self, probes: List, prob_input: torch.tensor)-> Tuple[torch.tensor, List]:
+        if self.incremental is None:
+            result = self.full_forward(prob_input)
+        else:
+            result = self.incremental.forward(probes, prob_input)
+            if self.channels is not None:
+                result = result[0], [x[self.channels[i]] for i, x in zip(self.layer_ind, result[1])]
+            if self.verify and self.keep_output:
+                self.incremental.verify(result, self.full_forward(prob_input), self.verify_tol)
+        if not self.keep_output:
+            return result[0][..., :0], result[1]
+        return result
+
+    def forward_adaptive(self, probes: List, prob_input: torch.tensor)-> Tuple[torch.tensor, List]:
+        """
+        Forward a probe batch. If the allocation fails, halve the batch size and forward the remaining probes in
+        chunks of the new batch size.
+        """
+        outs = []
+        b = 0
+        batch_size = len(prob_input)
+        while b<len(prob_input):
+            try:
+                outs.append(self.forward(probes[b:b+batch_size], prob_input[b:b+batch_size]))
+            except (RuntimeError, MemoryError) as e:
+                n = min(batch_size, len(prob_input)-b)
+                if not is_oom_error(e) or n==1:
+                    raise
+                self.batch_size = min(self.batch_size, max(1, n//2))
+                batch_size = self.batch_size
+                logging.warning(f"probe batch of {n} ran out of memory, retrying with batch size {batch_size}")
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                continue
+            b += batch_size
+        if len(outs)==1:
+            return outs[0]
+        output = torch.cat([x[0] for x in outs])
+        layer_act = [torch.cat([x[1][l] for x in outs], dim=-1) for l in range(len(outs[0][1]))]
+        return output, layer_act
+
+    def run(self, jobs: Iterable[ProbeJob])-> Iterator[Tuple[ProbeJob, torch.tensor, List]]:
+        """
+        Forward all probes of the given jobs and yield each job as soon as all its probes are done, in job order.
+        Input args:
+            jobs (Iterable): ProbeJob to be processed, may be a lazy generator
+        Return:
+            Iterator of (job, pred, layer_act)
+                pred (torch.tensor): L*C logits, one row per stimulation level
+                layer_act (List): list of n_l*L activation matrices, one per Conv2d/Linear layer
+        """
+        if self.batch_size is None:
+            self.batch_size = self.estimate_batch_size()
+        dataset = self.make_dataset(jobs)
+        job_list = {}
+        results = {}
+        finished = deque()
+        for probes, prob_input in dataset:
+            for j, s, job in probes:
+                if j not in job_list:
+                    job_list[j] = job
+                    results[j] = [None, None, 0]
+                    finished.append(j)
+            output, layer_act = self.forward_adaptive(probes, prob_input)
+            dataset.batch_size = self.batch_size
+            self._scatter(job_list, probes, output, layer_act, results)
+            yield from self._pop_finished(job_list, results, finished)
+
+    def _scatter(self, job_list: Dict, probes: List, output: torch.tensor, layer_act: List, results: Dict):
+        for b, (j, s, _) in enumerate(probes):
+            res = results[j]
+            if res[0] is None:
+                L = len(job_list[j].stim_seq)
+                res[0] = torch.zeros((L,)+tuple(output.shape[1:]))
+                res[1] = [torch.zeros(tuple(x.shape[:-1])+(L,)) for x in layer_act]
+            res[0][s] = output[b]
+            for l in range(len(layer_act)):
+                res[1][l][..., s] = layer_act[l][..., b]
+            res[2] += 1
+
+    def _pop_finished(self, job_list: Dict, results: Dict, finished: deque):
+        while finished and results[finished[0]][2]==len(job_list[finished[0]].stim_seq):
+            j = finished.popleft()
+            pred, layer_act, _ = results.pop(j)
+            yield job_list.pop(j), pred, layer_act
+
+
+class StackedProbeScheduler(PSFProbeScheduler):
+    """
+    PSFProbeScheduler for K models of the same architecture. Their parameters are stacked with
+    torch.func.stack_module_state and one probe batch runs through all of them in a single vmap-ed functional_call.
+    Incremental inference and int8 precision are not available in this mode.
+    Input args:
+        models (List): target models, same architecture, in eval mode and on psf_config['device']
+        example_dicts (List): example_dict of every model, all with the same class keys
+        psf_config (Dict): PSF configuration, see PSFProbeScheduler
+        sample_plans (List): Optional. Neuron sampling plan of every model, see PSFProbeScheduler
+    Yield (from run):
+        pred (torch.tensor): L*K*C logits
+        layer_act (List): list of K*n_l*L activation matrices
+    """
+
+    def __init__(self, models: List[torch.nn.Module], example_dicts: List[Dict], psf_config: Dict, sample_plans: List = None):
+        precision = psf_config.get('precision', 'fp32')
+        if precision=='int8':
+            logging.warning("int8 dynamic quantization is not supported for stacked models, probing in fp32")
+            precision = 'fp32'
+        super(StackedProbeScheduler, self).__init__(models[0], example_dicts[0], dict(psf_config, incremental=False, precision=precision),
+                                                    sample_plans[0] if sample_plans else None)
+        # Same architecture gives the same number of sampled neurons per layer, only the channels differ
+        self.gather_ind = None
+        if sample_plans:
+            self.gather_ind = []
+            for i in self.layer_ind:
+                ind = [torch.as_tensor(p['channels'][p['layer_ind'].index(i)], dtype=torch.long) for p in sample_plans]
+                self.gather_ind.append(torch.stack(ind).to(self.device))
+        self.example_dicts = example_dicts
+        self.n_models = len(models)
+        self.params, self.buffers = torch.func.stack_module_state(models)
+        # Stateless skeleton of the architecture, the stacked weights are bound at call time
+        self.base = copy.deepcopy(models[0]).to('meta')
+        layer_list = parse_arch(self.base)[0]
+        self.n_layers = len(self.layer_ind)
+        self.outs = []
+        for layer_ind in self.layer_ind:
+            layer_list[layer_ind].register_forward_hook(self._hook)
+
+    def _hook(self, module, f_in, f_out):
+        x = f_in if isinstance(f_in, torch.Tensor) else f_in[0]
+        # Reduce inside the vmap-ed call, only one value per neuron leaves the model
+        self.outs.append(self.reducer(x) if x.dim()==4 else x)
+
+    def _functional_forward(self, params: Dict, buffers: Dict, x: torch.tensor):
+        self.outs = []
+        output = torch.func.functional_call(self.base, (params, buffers), (x,))
+        return output, tuple(self.outs[:self.n_layers])
+
+    def estimate_probe_bytes(self)-> int:
+        return super(StackedProbeScheduler, self).estimate_probe_bytes()*self.n_models
+
+    def make_dataset(self, jobs: Iterable[ProbeJob])-> PSFProbeDataset:
+        return StackedProbeDataset(self.example_dicts, jobs, self.patch_size, self.device, self.batch_size)
+
+    def full_forward(self, prob_input: torch.tensor)-> Tuple[torch.tensor, List]:
+        """
+        Forward a B*K*C*H*W probe batch through the K models.
+        Return:
+            output (torch.tensor): B*K*C logits on cpu
+            layer_act (List): list of K*n_l*B activation matrices, one per Conv2d/Linear layer
+        """
+        with torch.no_grad(), self.autocast():
+            output, layer_act = torch.func.vmap(self._functional_forward, in_dims=(0, 0, 1), out_dims=(1, 0))(self.params, self.buffers, prob_input)
+        if self.gather_ind is not None:
+            # K*B*n -> K*B*n_sample with the channels of every model
+            layer_act = [x.gather(2, ind[:, None, :].expand(-1, x.shape[1], -1)) for x, ind in zip(layer_act, self.gather_ind)]
+        return output.detach().float().cpu(), [x.transpose(1, 2).float().cpu() for x in layer_act]
+
+
+class AdaptiveStimSearch:
+    """
+    Adaptive search over the stimulation levels of every job. The psf_config['stim_level'] levels of a job form the
+    dense grid; only psf_config['stim_init'] of them, evenly spread, are probed first. An interval between two probed
+    levels is bisected while the response changes by more than psf_config['stim_tol'] across it, so the probes
+    concentrate where the response changes fastest. Levels that are never probed are linearly interpolated from the
+    ends of their interval, and run yields the same dense L rows as the scheduler it wraps.
+    The response is the class confidence, or the activations relative to their largest magnitude when there are no
+    logits. Once the deadline has passed no interval is bisected any more, and the remaining jobs of a chunk are
+    handed over one by one on their initial levels.
+    Input args:
+        scheduler (PSFProbeScheduler): scheduler running the probes, may be a StackedProbeScheduler
+        psf_config (Dict): PSF configuration
+        deadline (float): Optional. time.time() after which the search stops bisecting
+    """
+
+    def __init__(self, scheduler: PSFProbeScheduler, psf_config: Dict, deadline: float = None):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.n_init = max(int(psf_config.get('stim_init', STIM_INIT)), 2)
+        self.tol = psf_config.get('stim_tol', STIM_TOL)
+        self.chunk = psf_config.get('stim_chunk', STIM_CHUNK)
+        # Probed and dense stimulation levels of the yielded jobs
+        self.n_probes = 0
+        self.n_dense = 0
+
+    @property
+    def warmup_time(self)-> float:
+        return self.scheduler.warmup_time
+
+    def change(self, pred: torch.tensor, layer_act: List, a: int, b: int)-> float:
+        """
+        Response change between the probed levels a and b.
+        """
+        if pred.shape[-1]:
+            conf = torch.softmax(pred[[a, b]].float(), -1)
+            return (conf[1]-conf[0]).abs().max().item()
+        act = torch.cat([x[..., [a, b]].flatten(0, -2) for x in layer_act])
+        return ((act[:, 1]-act[:, 0]).abs().max()/(act.abs().max()+1e-30)).item()
+
+    def out_of_time(self)-> bool:
+        return self.deadline is not None and time.time()>self.deadline
+
+    def run(self, jobs: Iterable[ProbeJob])-> Iterator[Tuple[ProbeJob, torch.tensor, List]]:
+        """
+        Search the stimulation levels of the given jobs, psf_config['stim_chunk'] jobs at a time.
+        Return:
+            Iterator of (job, pred, layer_act) on the dense stimulation grid of every job, in job order
+        """
+        jobs = iter(jobs)
+        while True:
+            chunk = list(itertools.islice(jobs, self.chunk))
+            if not chunk:
+                return
+            yield from self._search(chunk)
+
+    def _search(self, jobs: List[ProbeJob])-> Iterator[Tuple[ProbeJob, torch.tensor, List]]:
+        probed = [{} for _ in jobs]
+        todo = [sorted(set(np.linspace(0, len(job.stim_seq)-1, min(self.n_init, len(job.stim_seq))).round().astype(int))) for job in jobs]
+        while any(todo) and not self.out_of_time():
+            run_ind = [j for j in range(len(jobs)) if todo[j]]
+            for j in self._probe(jobs, probed, todo, run_ind):
+                if self.out_of_time():
+                    break
+            if self.out_of_time():
+                break
+            # Bisect the intervals whose response still changes too much
+            todo = [[] for _ in jobs]
+            for j in run_ind:
+                levels = sorted(probed[j])
+                pred = torch.stack([probed[j][s][0] for s in levels])
+                layer_act = [torch.stack([probed[j][s][1][l] for s in levels], -1) for l in range(len(probed[j][levels[0]][1]))]
+                for k in range(len(levels)-1):
+                    a, b = levels[k], levels[k+1]
+                    if b-a>1 and self.change(pred, layer_act, k, k+1)>self.tol:
+                        todo[j].append((a+b)//2)
+        # The scheduler runs jobs in order, so the jobs without any probe are the tail of a chunk that ran out of time
+        n_done = sum(1 for res in probed if res)
+        for j in range(n_done):
+            yield self._finish(jobs[j], probed[j])
+        for j in self._probe(jobs, probed, todo, range(n_done, len(jobs))):
+            yield self._finish(jobs[j], probed[j])
+
+    def _probe(self, jobs: List[ProbeJob], probed: List, todo: List, run_ind: Iterable[int])-> Iterator[int]:
+        """
+        Probe the todo levels of the jobs run_ind, yielding the index of every job once its levels are probed.
+        """
+        run_ind = list(run_ind)
+        sub_jobs = [ProbeJob(jobs[j].c, jobs[j].pos_ind, jobs[j].pos_w, jobs[j].pos_h, jobs[j].stim_seq[todo[j]]) for j in run_ind]
+        for j, (_, pred, layer_act) in zip(run_ind, self.scheduler.run(sub_jobs)):
+            for k, s in enumerate(todo[j]):
+                probed[j][s] = (pred[k], [x[..., k] for x in layer_act])
+            yield j
+
+    def _finish(self, job: ProbeJob, probed: Dict)-> Tuple[ProbeJob, torch.tensor, List]:
+        self.n_probes += len(probed)
+        self.n_dense += len(job.stim_seq)
+        return (job,)+self._interpolate(probed, len(job.stim_seq))
+
+    def _interpolate(self, probed: Dict, L: int)-> Tuple[torch.tensor, List]:
+        levels = sorted(probed)
+        pred = torch.zeros((L,)+tuple(probed[levels[0]][0].shape))
+        layer_act = [torch.zeros(tuple(x.shape)+(L,)) for x in probed[levels[0]][1]]
+        for a, b in zip(levels[:-1], levels[1:]):
+            for s in range(a, b):
+                t = (s-a)/(b-a)
+                pred[s] = (1-t)*probed[a][0]+t*probed[b][0]
+                for l in range(len(layer_act)):
+                    layer_act[l][..., s] = (1-t)*probed[a][1][l]+t*probed[b][1][l]
+        pred[levels[-1]] = probed[levels[-1]][0]
+        for l in range(len(layer_act)):
+            layer_act[l][..., levels[-1]] = probed[levels[-1]][1][l]
+        return pred, layer_act
@@ -24,7 +24,7 @@ from datetime import date
 from tqdm import tqdm
 import glob
 
-from topological_feature_extractor import topo_psf_feature_extract
+from topological_feature_extractor import topo_psf_feature_extract, fill_uncovered
 from run_crossval import run_crossval_xgb, run_crossval_mlp
 
 # Algorithm Configuration
@@ -33,8 +33,28 @@ PATCH_SIZE: int = 2 # Stimulation patch size used in PSF
 STIM_LEVEL: int = 4 # Number of stimulation level used in PSF
 N_SAMPLE_NEURONS: int = 1.5e3  # Number of neurons for sampling
 USE_EXAMPLE: bool =  False     # Whether clean inputs will be given or not
-CORR_METRIC: str = 'distcorr'   # Correlation metric to be used
+CORR_METRIC: str = 'distcorr'   # Correlation metric to be used, choice = {distcorr, distcorr_fast, distcorr_sketch, bc, cos, pearson, js}
+CORR_METHODS: List = None       # Further metrics computed from the same probing pass, e.g. ['pearson', 'cos'], see fv['metric_features']
 CLASSIFIER: str  = 'xgboost'    # Classifier for the detection , choice = {xgboost, mlp}.
+PROBE_MEM_MB: int = 1024       # Memory budget (MB) of one batch of PSF probes
+INCREMENTAL: bool = False      # Recompute only the receptive field touched by the PSF patch
+ACT_REDUCER: str = 'max'       # Spatial reducer of conv layer inputs, choice = {max, mean, l2, topk_mean, quantile}
+LAYER_SELECT: dict = {}        # Layers of the activation graph, keys {pattern, range, types}, empty for all Conv2d/Linear
+PRECISION: str = 'fp32'        # Precision of the probe forwards, choice = {fp32, bf16, int8}
+COMPILE: str = None            # Compile the probe graph once per architecture, choice = {None, jit, inductor}
+SCAN: str = 'uniform'          # PSF scan of the input, choice = {uniform, adaptive} (coarse-to-fine)
+STIM_SEARCH: str = 'grid'      # Stimulation levels probed at a position, choice = {grid, adaptive} (bisection)
+SCAN_ORDER: str = None         # Order the positions are visited in, choice = {raster, random, space_filling}, None for space_filling under a TIME_BUDGET and raster otherwise
+TIME_BUDGET: float = None      # Wall-clock budget (s) of the feature extraction of one model, None for no budget
+DCOR_MEM_MB: int = 1024        # Memory cap (MB) of the distcorr and js intermediates, larger activation graphs are computed blockwise
+CORR_THREADS: int = None       # Threads of the correlation metric, None for all cores
+SKETCH_TOL: float = 0.02       # Target error of distcorr_sketch, reported in the features as corr_error
+GREEDY_CUTOFF: float = None    # Insertion radius at which the furthest point sampling of the sparse filtration stops, None for exact
+MAXDIM: int = 1                # Highest homology dimension of the topological features, 0 uses the spanning tree H0 engine
+FILTRATION: str = 'auto'       # Filtration of the persistent diagrams, choice = {auto, exact, sparse, threshold}, see plan_filtration
+PH_TIME_BUDGET: float = None   # Ripser time budget (s) of a position the filtration is planned for, None for size based planning
+PH_WORKERS: int = 0            # Processes computing the persistent diagrams while probing goes on, 0 for in process
+PH_QUEUE_DEPTH: int = None     # Distance matrices waiting for a persistent homology worker at most, None for 2*PH_WORKERS
 # Experiment Configuration
 INPUT_SIZE: List = [1, 28, 28] # Input images' shape (default to be MNIST)
 INPUT_RANGE: List = [0, 255]   # Input image range
@@ -62,6 +82,26 @@ def main(args):
     psf_config['input_range'] = INPUT_RANGE
     psf_config['n_neuron'] = N_SAMPLE_NEURONS
     psf_config['corr_method'] = CORR_METRIC
+    psf_config['corr_methods'] = CORR_METHODS
+    psf_config['probe_mem_mb'] = PROBE_MEM_MB
+    psf_config['incremental'] = INCREMENTAL
+    psf_config['act_reducer'] = ACT_REDUCER
+    psf_config['layer_select'] = LAYER_SELECT
+    psf_config['precision'] = PRECISION
+    psf_config['compile'] = COMPILE
+    psf_config['scan'] = SCAN
+    psf_config['stim_search'] = STIM_SEARCH
+    psf_config['scan_order'] = SCAN_ORDER
+    psf_config['time_budget'] = TIME_BUDGET
+    psf_config['dcor_mem_mb'] = DCOR_MEM_MB
+    psf_config['corr_threads'] = CORR_THREADS
+    psf_config['sketch_tol'] = SKETCH_TOL
+    psf_config['greedy_cutoff'] = GREEDY_CUTOFF
+    psf_config['maxdim'] = MAXDIM
+    psf_config['filtration'] = FILTRATION
+    psf_config['ph_time_budget'] = PH_TIME_BUDGET
+    psf_config['ph_workers'] = PH_WORKERS
+    psf_config['ph_queue_depth'] = PH_QUEUE_DEPTH
     psf_config['device'] = device
 
     root = args.data_root
@@ -145,6 +185,8 @@ def main(args):
 
     # --------------------------------- Step II: Train Classifier ---------------------------------
     print(">>> Step II: Train Classifier <<<")
+    # Time-budgeted extraction may leave positions uncovered
+    fv_list=[fill_uncovered(fv) for fv in fv_list]
     if CLASSIFIER=='xgboost':
 
         # PSF feature shape = N*2*m*w*h*L*C
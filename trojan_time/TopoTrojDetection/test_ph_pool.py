@@ -0,0 +1,42 @@
+"""
+Persistent homology worker pool (PH_WORKERS>0) under the process pools COMPETITION_run_troj_detector.py runs its
+models in.
+"""
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from networks import ModdedLeNet5Net
+from topological_feature_extractor import topo_psf_feature_extract
+
+
+def extract(ph_workers: int):
+    torch.manual_seed(0)
+    model = ModdedLeNet5Net().eval()
+    example_dict = defaultdict(list)
+    for c in range(2):
+        example_dict[c].append(torch.rand(1, 1, 28, 28)*255)
+    psf_config = {'step_size': 14, 'stim_level': 4, 'patch_size': 2, 'input_shape': [1, 28, 28], 'input_range': [0, 255],
+                  'n_neuron': 1.5e3, 'corr_method': 'pearson', 'device': torch.device('cpu'), 'ph_workers': ph_workers}
+    fv = topo_psf_feature_extract(model, example_dict, psf_config)
+    return fv['topo_feature_pos'].numpy(), fv['timing']
+
+
+def test_ph_workers_in_runner_executor():
+    ref, _ = extract(0)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        topo, timing = pool.submit(extract, 2).result()
+    assert 'ph_pool' in timing
+    np.testing.assert_array_equal(topo, ref)
+
+
+def test_ph_workers_in_daemonic_pool():
+    ref, _ = extract(0)
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        topo, timing = pool.apply(extract, (2,))
+    # Daemonic workers can not have children, the diagrams are computed in process
+    assert 'ph_pool' not in timing
+    np.testing.assert_array_equal(topo, ref)
@@ -8,9 +8,13 @@ import os
 import gc
 import re
 from collections import defaultdict
-from typing import List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, List, Tuple, Dict
 
 import torch
+import torch.fx as fx
 import torch.utils.data as data
 import numpy as np
 import pandas as pd
@@ -18,6 +22,13 @@ import skimage.io
 
 # Total number of neurons to be sampled
 SAMPLE_LIMIT = 3e3
+# Memory cap (in MB) of the intermediate tensors of a distance correlation or JS divergence matrix
+DCOR_MEM_MB = 1024
+# Neuron pairs processed together by the sorting-based distance covariance
+DCOR_PAIR_CHUNK = 4096
+# Target error of the sketched distance correlation, and the number of sampled entries it starts from
+SKETCH_TOL = 0.02
+SKETCH_INIT = 256
 
 def img_std(img):
     """
@@ -96,6 +107,237 @@ def feature_collect(model: torch.tensor, images: torch.tensor)-> Tuple[Dict, tor
     return feature_dict, output
 
 
+def select_layers(model: torch.nn.Module, psf_config: Dict)-> List[int]:
+    """
+    Select the Conv2d/Linear layers whose inputs build the activation graph. psf_config['layer_select'] is an optional
+    dictionary, all given keys must match:
+        'pattern' (str): regular expression searched in the qualified module name, e.g. 'layer[34]'
+        'range' (List): [start, end) range of the layer depth, as a python slice (negative indices allowed)
+        'types' (List): module type names, e.g. ['Conv2d']
+    Input args:
+        model (torch.nn.Module): A torch network
+        psf_config (Dict): PSF configuration
+    Return:
+        layer_ind (List): Indices of the selected layers in the return of parse_arch, from shallow to deep
+    """
+    layer_list = parse_arch(model)[0]
+    layer_select = psf_config.get('layer_select') or {}
+    layer_ind = list(range(len(layer_list)))
+    if layer_select.get('range') is not None:
+        layer_ind = layer_ind[slice(*layer_select['range'])]
+    if layer_select.get('pattern'):
+        module_names = {id(m): n for n, m in model.named_modules()}
+        layer_ind = [i for i in layer_ind if re.search(layer_select['pattern'], module_names[id(layer_list[i])])]
+    if layer_select.get('types'):
+        layer_ind = [i for i in layer_ind if layer_list[i]._get_name() in layer_select['types']]
+    if not layer_ind:
+        raise Exception(f"Layer selection {layer_select} matches none of the Conv2d/Linear layers")
+    return layer_ind
+
+
+def gather_channels(x: torch.tensor, channels: Dict, layer_ind: int)-> torch.tensor:
+    """
+    Keep the channels[layer_ind] channels (dim 1) of x. The index tensor is moved to the device of x once and cached.
+    """
+    ind = channels[layer_ind]
+    if ind.device!=x.device:
+        ind = channels[layer_ind] = ind.to(x.device)
+    return x.index_select(1, ind)
+
+
+class GraphFeatureExtractor:
+    """
+    FX-traced alternative to ActivationRecorder. The graph returns the inputs of the selected layers directly, and
+    every node that neither they nor the logits (if keep_output) depend on is removed, so the forward stops right
+    after the last module needed. Raises if the model can not be traced.
+    Input args:
+        model (torch.nn.Module): A torch network
+        layer_ind (List): Indices (into parse_arch) of the layers to return, see select_layers
+        keep_output (bool): Whether the logits are still computed
+        reducer (callable): Optional. Applied to B*C*H*W layer inputs on the model's device, see ACT_REDUCERS
+        channels (Dict): Optional. Layer index to the channels (LongTensor) to keep, see make_sample_plan
+        layer_list (Tuple): Optional. Return of parse_arch to use instead of parsing model, see ActivationRecorder
+    """
+
+    def __init__(self, model: torch.nn.Module, layer_ind: List, keep_output: bool = True, reducer=None, channels: Dict = None, layer_list: Tuple = None):
+        self.layer_list, self.layer_k = layer_list if layer_list is not None else parse_arch(model)
+        self.layer_ind = list(layer_ind)
+        self.keep_output = keep_output
+        self.reducer = reducer
+        self.channels = dict(channels) if channels else {}
+        self.gm = fx.symbolic_trace(model)
+        modules = dict(self.gm.named_modules())
+        targets = {id(self.layer_list[i]): i for i in self.layer_ind}
+        layer_inputs = {}
+        for node in self.gm.graph.nodes:
+            if node.op=='call_module' and id(modules[node.target]) in targets:
+                # Like the hooks, the first call of a module is the one recorded
+                layer_inputs.setdefault(targets[id(modules[node.target])], node.args[0])
+        missing = [self.layer_k[i] for i in self.layer_ind if i not in layer_inputs]
+        if missing:
+            raise Exception(f"Layers {missing} are not called in the traced graph")
+        output_node = next(node for node in self.gm.graph.nodes if node.op=='output')
+        outputs = (tuple(layer_inputs[i] for i in self.layer_ind),)
+        output_node.args = (outputs+(output_node.args[0],) if keep_output else outputs,)
+        self.gm.graph.eliminate_dead_code()
+        self.gm.recompile()
+
+    def record(self, images: torch.tensor)-> Tuple[Dict, torch.tensor]:
+        """
+        Same as ActivationRecorder.record. output is None if keep_output is False.
+        """
+        outputs = self.run(images)
+        layer_inputs, output = outputs[0], outputs[1] if self.keep_output else None
+        feature_dict = {}
+        for layer_ind, x in zip(self.layer_ind, layer_inputs):
+            if self.reducer is not None and x.dim()==4:
+                x = self.reducer(x)
+            if layer_ind in self.channels:
+                x = gather_channels(x, self.channels, layer_ind)
+            feature_dict[(layer_ind, self.layer_k[layer_ind])] = x.detach().cpu()
+        return feature_dict, output
+
+    def run(self, images: torch.tensor)-> Tuple:
+        return self.gm(images)
+
+
+def reduce_topk_mean(x: torch.tensor, k: int = 8)-> torch.tensor:
+    """
+    Mean of the k largest spatial values of every channel of a B*C*H*W tensor.
+    """
+    x = x.flatten(2)
+    return x.topk(min(k, x.shape[2]), dim=2)[0].mean(2)
+
+
+def reduce_quantile(x: torch.tensor, q: float = 0.9)-> torch.tensor:
+    """
+    q-quantile (linear interpolation as torch.quantile) of the spatial values of every channel of a B*C*H*W tensor.
+    torch.quantile itself refuses inputs larger than 2**24 elements, so it is done with a sort.
+    """
+    x = x.flatten(2).sort(dim=2)[0]
+    pos = q*(x.shape[2]-1)
+    lo = int(pos)
+    hi = min(lo+1, x.shape[2]-1)
+    return x[:, :, lo]+(x[:, :, hi]-x[:, :, lo])*(pos-lo)
+
+
+# Spatial reducers turning a B*C*H*W layer input into the B*C activation of its neurons
+ACT_REDUCERS = {
+    'max': lambda x: x.amax((2, 3)),
+    'mean': lambda x: x.mean((2, 3)),
+    'l2': lambda x: torch.linalg.vector_norm(x, dim=(2, 3)),
+    'topk_mean': reduce_topk_mean,
+    'quantile': reduce_quantile,
+}
+
+
+def get_act_reducer(psf_config: Dict):
+    """
+    Reducer selected by psf_config['act_reducer'] (default 'max'). 'topk_mean' reads psf_config['reducer_k'] (default 8)
+    and 'quantile' reads psf_config['reducer_q'] (default 0.9).
+    """
+    name = psf_config.get('act_reducer', 'max')
+    if name not in ACT_REDUCERS:
+        raise Exception(f"Unknown activation reducer {name}, choose from {list(ACT_REDUCERS)}")
+    if name=='topk_mean':
+        return partial(reduce_topk_mean, k=psf_config.get('reducer_k', 8))
+    if name=='quantile':
+        return partial(reduce_quantile, q=psf_config.get('reducer_q', 0.9))
+    return ACT_REDUCERS[name]
+
+
+class ActivationRecorder:
+    """
+    Long-lived counterpart of feature_collect. Hooks are registered once on every Conv2d/Linear module and, while
+    recording, the layer inputs are written into preallocated buffers indexed by batch slot.
+    Input args:
+        model (torch.nn.Module): A torch network
+        capacity (int): Number of batch slots of every buffer, grown on demand
+        device (torch.device): Device the buffers live on, default to cpu as feature_collect
+        pin_memory (bool): Pin the cpu buffers so the copy out of a cuda model does not block
+        reducer (callable): Optional. Applied to B*C*H*W layer inputs inside the hook, on the model's device, so only
+            the B*C result is copied to the buffers. See ACT_REDUCERS
+        layer_ind (List): Optional. Indices (into parse_arch) of the layers to record, see select_layers
+        channels (Dict): Optional. Layer index to the channels (LongTensor) kept by the hook, see make_sample_plan
+        layer_list (Tuple): Optional. Return of parse_arch to use instead of parsing model, for models whose layers
+            were swapped (e.g. quantized) and are no longer Conv2d/Linear
+    """
+
+    def __init__(self, model: torch.nn.Module, capacity: int = 1, device: torch.device = torch.device('cpu'), pin_memory: bool = False, reducer=None, layer_ind: List = None, channels: Dict = None, layer_list: Tuple = None):
+        self.model = model
+        self.reducer = reducer
+        self.channels = dict(channels) if channels else {}
+        self.layer_list, self.layer_k = layer_list if layer_list is not None else parse_arch(model)
+        self.layer_ind = list(range(len(self.layer_list))) if layer_ind is None else list(layer_ind)
+        self.capacity = capacity
+        self.device = torch.device(device)
+        self.pin_memory = pin_memory and self.device.type=='cpu' and torch.cuda.is_available()
+        self.buffers = [None]*len(self.layer_list)
+        self.slot = 0
+        self.active = False
+        self.handle_list = [self.layer_list[layer_ind].register_forward_hook(hook=self._make_hook(layer_ind)) for layer_ind in self.layer_ind]
+
+    def _make_hook(self, layer_ind: int):
+        def feature_hook(module, f_in, f_out):
+            # Forwards outside of record (shape probing, test inputs, ...) are ignored
+            if not self.active:
+                return
+            x = f_in if isinstance(f_in, torch.Tensor) else f_in[0]
+            if self.reducer is not None and x.dim()==4:
+                x = self.reducer(x)
+            if layer_ind in self.channels:
+                x = gather_channels(x, self.channels, layer_ind)
+            self._write(layer_ind, x.detach())
+        return feature_hook
+
+    def _write(self, layer_ind: int, x: torch.tensor):
+        buf = self.buffers[layer_ind]
+        end = self.slot+len(x)
+        if buf is None or buf.shape[1:]!=x.shape[1:] or buf.dtype!=x.dtype or len(buf)<end:
+            self.capacity = max(self.capacity, end)
+            new_buf = torch.empty((self.capacity,)+tuple(x.shape[1:]), dtype=x.dtype, device=self.device, pin_memory=self.pin_memory)
+            if buf is not None and buf.shape[1:]==x.shape[1:] and buf.dtype==x.dtype:
+                new_buf[:self.slot] = buf[:self.slot]
+            self.buffers[layer_ind] = buf = new_buf
+        buf[self.slot:end].copy_(x, non_blocking=self.pin_memory)
+
+    def record(self, images: torch.tensor, slot: int = 0)-> Tuple[Dict, torch.tensor]:
+        """
+        Forward images and write the layer inputs to batch slots [slot, slot+len(images)).
+        Input args:
+            images (torch.tensor): A valid image torch.tensor
+            slot (int): First batch slot to write to
+        Return:
+            feature_dict (dict): Views of the buffers whose key is the (layer depth, module name). They are only valid
+                until the next record call that writes the same slots
+            output (torch.tensor): final output of model
+        """
+        self.slot = slot
+        self.active = True
+        try:
+            output = self.model(images)
+        finally:
+            self.active = False
+        if self.pin_memory:
+            torch.cuda.synchronize()
+        feature_dict = {}
+        for layer_ind in self.layer_ind:
+            feature_dict[(layer_ind, self.layer_k[layer_ind])] = self.buffers[layer_ind][slot:slot+len(images)]
+        return feature_dict, output
+
+    def close(self):
+        for handle in self.handle_list:
+            handle.remove()
+        self.handle_list = []
+        self.buffers = [None]*len(self.layer_list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def sample_act(neural_act: torch.tensor, layer_list: List, sample_size: int)-> Tuple[torch.tensor, List]:
     """
     Stratified sampling certain number of neurons' output given all activating vector of a model.
@@ -118,6 +360,31 @@ def sample_act(neural_act: torch.tensor, layer_list: List, sample_size: int)-> T
     return neural_act[sample_ind], sample_n_neurons_list
 
 
+def make_sample_plan(layer_list: List, layer_ind: List, sample_size: int, threshold: float = 1.5e3, seed: int = 0)-> Dict:
+    """
+    Fixed counterpart of sample_act. The stratified sample of neurons is drawn once per model, so it is the same at
+    every position and only the sampled channels need to be recorded.
+    Input args:
+        layer_list (List): Return of parse_arch
+        layer_ind (List): Indices of the selected layers, see select_layers
+        sample_size (int): Interger that specifies the number of neurons to be sampled
+        threshold (float): No sampling if the selected layers have at most this many neurons in total
+        seed (int): Seed of the draw
+    Return:
+        sample_plan (Dict): None if no sampling is needed, otherwise
+            'layer_ind' (List): layer_ind
+            'sample_size' (int): sample_size
+            'channels' (List): sorted sampled channel indices of every selected layer, possibly empty
+    """
+    n_neurons_list = [layer_list[0][i].in_channels if hasattr(layer_list[0][i], "in_channels") else layer_list[0][i].in_features for i in layer_ind]
+    if sum(n_neurons_list)<=threshold:
+        return None
+    rng = np.random.RandomState(seed)
+    layer_sample_num = [int(sample_size * x / sum(n_neurons_list)) for x in n_neurons_list]
+    channels = [np.sort(rng.choice(n, k, replace=False)) for n, k in zip(n_neurons_list, layer_sample_num)]
+    return {'layer_ind': list(layer_ind), 'sample_size': sample_size, 'channels': channels}
+
+
 def process_pd(pd: torch.tensor, layer_list: List, sample_n_neurons_list: List=None)-> torch.tensor:
     if not sample_n_neurons_list:
         # If the target sampling neurons list is not given then set it to be the whole layer_list
@@ -142,7 +409,51 @@ def process_pd(pd: torch.tensor, layer_list: List, sample_n_neurons_list: List=N
     return maxpool_pd
 
 
-def mat_discorr_adjacency(X: torch.tensor, Y: torch.tensor = None)-> torch.tensor:
+def discorr_gram_blocked(X: torch.tensor, max_bytes: int)-> torch.tensor:
+    """
+    Gram matrix of the double-centred distance matrices of all row vectors in X, without materializing the n*d*d
+    distance tensor. The distance matrices are built a block of rows and a tile of neurons at a time, once to get
+    their row means and once to accumulate the n*n Gram matrix tile by tile.
+    Input args:
+        X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
+        max_bytes (int). Bound on the size of the distance blocks alive at the same time.
+    Return:
+        n*n Gram matrix, sum_{i,j} A_{i,j} B_{i,j} for every pair of neurons
+    """
+    n, d = X.shape
+    elem = X.element_size()
+    # Two centred blocks and their temporaries are alive at the same time
+    block_bytes = max(max_bytes//4, 1)
+    tile = n if n*d*elem<=block_bytes else max(1, block_bytes//(d*elem))
+    rows = max(1, min(d, block_bytes//(tile*d*elem)))
+    tiles = [slice(i, min(i+tile, n)) for i in range(0, n, tile)]
+
+    def dist(neurons, r):
+        return (X[neurons, r, None]-X[neurons, None, :]).abs()
+
+    # Distance matrices are symmetric, their row means are also their column means
+    row_mean = torch.zeros(n, d, dtype=X.dtype, device=X.device)
+    for r in range(0, d, rows):
+        for t in tiles:
+            row_mean[t, r:r+rows] = dist(t, slice(r, r+rows)).mean(2)
+    grand_mean = row_mean.mean(1)
+
+    def centred(neurons, r):
+        return (dist(neurons, r)-row_mean[neurons, r, None]-row_mean[neurons, None, :]+grand_mean[neurons, None, None]).flatten(1)
+
+    gram = torch.zeros(n, n, dtype=X.dtype, device=X.device)
+    for r in range(0, d, rows):
+        r = slice(r, r+rows)
+        for i, t_i in enumerate(tiles):
+            a = centred(t_i, r)
+            for t_j in tiles[i:]:
+                b = a if t_j==t_i else centred(t_j, r)
+                gram[t_i, t_j] += a@b.T
+    # Only the upper tiles were accumulated
+    return torch.triu(gram)+torch.triu(gram, 1).T
+
+
+def mat_discorr_adjacency(X: torch.tensor, Y: torch.tensor = None, max_mem_mb: int = DCOR_MEM_MB)-> torch.tensor:
     """
     Distance-correlation matrix calculation in tensor format. Return pairwise distance correlation among all row vectors in X. 
 
@@ -163,6 +474,8 @@ def mat_discorr_adjacency(X: torch.tensor, Y: torch.tensor = None)-> torch.tenso
     Input args:
         X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
         Y (torch.tensor). Optional.
+        max_mem_mb (int). Memory cap of the intermediate tensors. When the n*d*d distance tensor does not fit, the
+            Gram matrix is accumulated blockwise by discorr_gram_blocked.
     """
     n, m = X.shape
     # If Y is not given, then calculate distcorr(X, X)
@@ -173,20 +486,122 @@ def mat_discorr_adjacency(X: torch.tensor, Y: torch.tensor = None)-> torch.tenso
     # if (64*n**2)/(10**9) < 8:
     #     X = X.cuda()
     #     Y = Y.cuda()
-    bpd = torch.cdist(X.unsqueeze(2), Y.unsqueeze(2), p=2)
-    bpd = bpd - bpd.mean(axis=1)[:, None, :] - bpd.mean(axis=2)[:, : , None] + bpd.mean((1, 2))[:, None, None]
-    pd = torch.mm(bpd.view(n, -1), bpd.view(n, -1).T)
-    del bpd, X, Y
-    gc.collect()
-    torch.cuda.empty_cache()
+    max_bytes = int(max_mem_mb*2**20)
+    # The distance tensor, its centred copy and the means
+    if 3*n*m*m*X.element_size() > max_bytes:
+        pd = discorr_gram_blocked(X, max_bytes)
+    else:
+        bpd = torch.cdist(X.unsqueeze(2), Y.unsqueeze(2), p=2)
+        bpd = bpd - bpd.mean(axis=1)[:, None, :] - bpd.mean(axis=2)[:, : , None] + bpd.mean((1, 2))[:, None, None]
+        pd = torch.mm(bpd.view(n, -1), bpd.view(n, -1).T)
+        del bpd, X, Y
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    return discorr_from_gram(pd, n)
 
+
+def discorr_from_gram(pd: torch.tensor, n: int)-> torch.tensor:
+    """
+    Distance correlation matrix from the Gram matrix of the double-centred distance matrices.
+    """
     pd/=n**2
+    # Tied or constant records can leave entries slightly below zero
+    pd.clamp_(min=0)
     pd=torch.sqrt(pd)
     pd/=(torch.sqrt(torch.diagonal(pd)[None, :]*torch.diagonal(pd)[:, None])+1e-8)
     pd.fill_diagonal_(1)
 
     return pd
 
+
+def _distance_row_sums(X: torch.tensor)-> Tuple[torch.tensor, torch.tensor, torch.tensor, torch.tensor]:
+    """
+    Row sums of the distance matrices of all row vectors in X from one sort of every row,
+    sum_j |x_k-x_j| = (2r-d+1)x_k - sum_{x_j<x_k} x_j + sum_{x_j>x_k} x_j with r the rank of x_k.
+    Return:
+        row sums, sorted X, sorting order and cumulative sums of sorted X
+    """
+    d = X.shape[1]
+    xs, order = X.sort(1)
+    cs = xs.cumsum(1)
+    rank = torch.arange(d, dtype=X.dtype, device=X.device)
+    row_sum = torch.empty_like(X).scatter_(1, order, (2*rank-d+1)*xs-(cs-xs)+(cs[:, -1:]-cs))
+    return row_sum, xs, order, cs
+
+
+def _dominance_sum(x: torch.tensor, y: torch.tensor, w: torch.tensor)-> torch.tensor:
+    """
+    sum_{i<j, y_i<y_j} (x_j-x_i)(y_j-y_i) for every row of P*D tensors x (sorted ascending, D a power of 2) and y.
+    Padding entries have weight w=0. The pairs (i, j) are counted level by level of a merge tree: at the level of
+    block size s, i runs over a left block and j over its right sibling, and the sums over i<j with y_i<y_j come from
+    the prefix sums of the left block sorted by y.
+    """
+    P, D = x.shape
+    total = torch.zeros(P, dtype=x.dtype, device=x.device)
+    s = 1
+    while s<D:
+        xb, yb, wb = [t.view(P, D//(2*s), 2, s) for t in (x, y, w)]
+        yl, order = yb[:, :, 0].sort(-1)
+        xl, wl = xb[:, :, 0].gather(-1, order), wb[:, :, 0].gather(-1, order)
+        # Prefix sums of 1, x, y and x*y over the left block, with a leading zero
+        prefix = torch.stack([wl, wl*xl, wl*yl, wl*xl*yl]).cumsum(-1)
+        prefix = torch.nn.functional.pad(prefix, (1, 0))
+        pos = torch.searchsorted(yl.contiguous(), yb[:, :, 1].contiguous())
+        c, sx, sy, sxy = prefix.gather(-1, pos[None].expand(4, -1, -1, -1))
+        xr, yr, wr = xb[:, :, 1], yb[:, :, 1], wb[:, :, 1]
+        total += (wr*(c*xr*yr-xr*sy-yr*sx+sxy)).sum((1, 2))
+        s *= 2
+    return total
+
+
+def mat_discorr_fast_adjacency(X: torch.tensor, n_threads: int = None, pair_chunk: int = DCOR_PAIR_CHUNK)-> torch.tensor:
+    """
+    Distance-correlation matrix of all row vectors in X with the sorting-based algorithm for univariate samples
+    (Huo and Szekely, 2016). Every neuron trace is 1-D, so the double-centred Gram entry of two neurons a and b is
+
+        sum_{i,j} A_{i,j} B_{i,j} = T(a, b) + a_{..}*b_{..}/d^2 - 2/d sum_i a_{i.}*b_{i.}
+
+    with T(a, b) = sum_{i,j} |a_i-a_j||b_i-b_j| and a_{i.}, a_{..} the row and total sums of the distance matrix.
+    The row sums come from one sort of every neuron and the last two terms are n*n products. T is computed pair by
+    pair from sorts and prefix sums, with O(d) memory per pair instead of the d*d distance matrices of
+    mat_discorr_adjacency. Chunks of neuron pairs are processed by a thread pool. Matches mat_discorr_adjacency up to
+    floating point error, and beats it once d is large (see bench_corr.py).
+    Input args:
+        X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
+        n_threads (int). Optional. Threads processing pair chunks, default os.cpu_count().
+        pair_chunk (int). Number of neuron pairs handled together.
+    """
+    n, d = X.shape
+    dtype = X.dtype
+    X = X.double()
+    row_sum, xs, order, cs = _distance_row_sums(X)
+    total = row_sum.sum(1)
+    gram = total[:, None]*total[None, :]/d**2-2/d*row_sum@row_sum.T
+
+    # Pad to a power of 2 with weightless samples at the end of the x order
+    D = 1<<max(d-1, 1).bit_length()
+    w = torch.nn.functional.pad(torch.ones(1, d, dtype=X.dtype, device=X.device), (0, D-d))
+    xs_pad = torch.nn.functional.pad(xs, (0, D-d), value=0.)
+    sum_xy = X@X.T
+    p_ind, q_ind = torch.triu_indices(n, n)
+
+    def cross_term(lo, hi):
+        p, q = p_ind[lo:hi], q_ind[lo:hi]
+        # Sorting by a, T = 2*sum_{i<j} (a_j-a_i)|b_j-b_i| = 2*(2*sum_{i<j, b_i<b_j} (a_j-a_i)(b_j-b_i) - G) where
+        # G = sum_{i<j} (a_j-a_i)(b_j-b_i) = d*sum_i a_i*b_i - sum_i a_i*sum_i b_i
+        y = torch.nn.functional.pad(X[q].gather(1, order[p]), (0, D-d))
+        dom = _dominance_sum(xs_pad[p], y, w.expand(len(p), -1))
+        G = d*sum_xy[p, q]-cs[p, -1]*cs[q, -1]
+        gram[p, q] += 2*(2*dom-G)
+
+    chunks = [(lo, min(lo+pair_chunk, len(p_ind))) for lo in range(0, len(p_ind), pair_chunk)]
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        list(pool.map(lambda c: cross_term(*c), chunks))
+    gram = torch.triu(gram)+torch.triu(gram, 1).T
+
+    return discorr_from_gram(gram.clamp(min=0).to(dtype), n)
+
 # TODO: finish all following doc
 def mat_bc_adjacency(X):
     '''
@@ -203,7 +618,6 @@ def mat_bc_adjacency(X):
     if torch.any(X < 0):
         raise ValueError('Each value shoule in the range [0,1]')
 
-    X = X.cuda()
     X_sqrt = torch.sqrt(X)
     return torch.matmul(X_sqrt, X_sqrt.T)
 
@@ -215,7 +629,6 @@ def mat_cos_adjacency(X):
         X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
         Y (torch.tensor). Optional.
     '''
-    X = X.cuda()
     X_row_l2_norm = torch.norm(X, p=2, dim=1).view(-1, 1)
     X_row_std = X/(X_row_l2_norm+1e-4)
     return torch.matmul(X_row_std, X_row_std.T)
@@ -228,16 +641,90 @@ def mat_pearson_adjacency(X):
         X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
         Y (torch.tensor). Optional.
     '''
-    X = X.cuda()
     X = X - X.mean(1).view(-1, 1)
     cov = torch.matmul(X, X.T)
-    eps = torch.tensor(1e-4).cuda()
+    eps = X.new_tensor(1e-4)
     sigma = torch.maximum(torch.sqrt(torch.diagonal(cov)), eps)+1e-4
     corr  = cov/sigma.view(-1, 1)/sigma.view(1, -1)
     corr.fill_diagonal_(1)
     return corr
 
-def mat_jsdiv_adjacency(X):
+class StreamingCorrelation:
+    """
+    Running moments of n neurons fed one batch of records at a time, from which the Pearson and cosine matrices of
+    mat_pearson_adjacency and mat_cos_adjacency are finalized without keeping the n*d activations. Batches are folded
+    in with the pairwise update of Chan et al., so accumulators filled by parallel workers on disjoint records merge
+    into the one of the whole stream.
+    Input args:
+        n (int): Number of neurons
+        device (torch.device): Device of the accumulators
+        dtype (torch.dtype): Dtype of the accumulators, float64 so long streams do not lose the co-moments
+    """
+
+    def __init__(self, n: int, device: torch.device = torch.device('cpu'), dtype: torch.dtype = torch.float64):
+        self.count = 0
+        self.mean = torch.zeros(n, device=device, dtype=dtype)
+        self.comoment = torch.zeros(n, n, device=device, dtype=dtype)
+
+    def update(self, X: torch.tensor):
+        """
+        Fold in the records of X (n*b tensor, one column per record).
+        """
+        if X.shape[1]==0:
+            return self
+        X = X.to(self.mean)
+        mean = X.mean(1)
+        X = X-mean.view(-1, 1)
+        return self._fold(X.shape[1], mean, torch.matmul(X, X.T))
+
+    def merge(self, other: 'StreamingCorrelation'):
+        """
+        Fold in the accumulator of another worker.
+        """
+        if other.count==0:
+            return self
+        return self._fold(other.count, other.mean.to(self.mean), other.comoment.to(self.comoment))
+
+    def _fold(self, count: int, mean: torch.tensor, comoment: torch.tensor):
+        total = self.count+count
+        delta = mean-self.mean
+        self.comoment += comoment+torch.outer(delta, delta)*(self.count*count/total)
+        self.mean += delta*(count/total)
+        self.count = total
+        return self
+
+    def _moments(self, standardize: bool)-> Tuple[torch.tensor, torch.tensor]:
+        # Per-neuron standardization as in the feature extractors, applied to the moments instead of the records
+        if not standardize:
+            return self.mean, self.comoment
+        std = torch.sqrt(torch.diagonal(self.comoment)/max(self.count-1, 1))+1e-30
+        return torch.zeros_like(self.mean), self.comoment/std.view(-1, 1)/std.view(1, -1)
+
+    def pearson(self, standardize: bool = False)-> torch.tensor:
+        """
+        Return: n*n float32 matrix of mat_pearson_adjacency applied to all records folded in so far, after
+            standardizing every neuron if standardize.
+        """
+        _, cov = self._moments(standardize)
+        eps = cov.new_tensor(1e-4)
+        sigma = torch.maximum(torch.sqrt(torch.diagonal(cov)), eps)+1e-4
+        corr = cov/sigma.view(-1, 1)/sigma.view(1, -1)
+        corr.fill_diagonal_(1)
+        return corr.float()
+
+    def cos(self, standardize: bool = False)-> torch.tensor:
+        """
+        Return: n*n float32 matrix of mat_cos_adjacency applied to all records folded in so far, after standardizing
+            every neuron if standardize.
+        """
+        mean, cov = self._moments(standardize)
+        gram = cov+torch.outer(mean, mean)*self.count
+        norm = torch.sqrt(torch.clamp(torch.diagonal(gram), min=0))+1e-4
+        return (gram/norm.view(-1, 1)/norm.view(1, -1)).float()
+
+STREAMING_CORR = {'pearson': StreamingCorrelation.pearson, 'cos': StreamingCorrelation.cos}
+
+def mat_jsdiv_adjacency(X, max_mem_mb: int = DCOR_MEM_MB, n_threads: int = None):
     '''
     Jensen-Shannon Divergence matrix version. Return pairwise JS divergence among all row vectors in X. 
 
@@ -248,15 +735,233 @@ def mat_jsdiv_adjacency(X):
             m = (a+b)/2
             KL is the Kullback-Leibler divergence
 
+    The cross terms sum_k (a_k+b_k)*log((a_k+b_k)/2) are computed tile by tile of rows and columns, on tiles of
+    at most max_mem_mb spread over n_threads threads, instead of one n*d*n tensor.
+
     Input args:
         X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
-        Y (torch.tensor). Optional.
+        max_mem_mb (int). Memory cap of the tiles alive at the same time.
+        n_threads (int). Optional. Threads processing tiles, default 1.
     '''
 
     if torch.any(X < 0):
         raise ValueError('Each value shoule in the range [0,1]')
 
-    paq = X[:, :, None] + X.T[None, :, :]
-    logpaq  = torch.log(paq+1e-4)
-    paqdiag = torch.diag((paq/2*torch.log(paq/2+1e-4)).sum(1)).flatten()
-    return 1/2*(paqdiag[:, None]+paqdiag[None, :]-(paq*torch.log(paq/2+1e-4)).sum(1))
\ No newline at end of file
+    n, d = X.shape
+    n_threads = n_threads or 1
+    # One tile, its log and their product per thread
+    tile_bytes = max(int(max_mem_mb*2**20)//(3*n_threads), 1)
+    tile = max(1, min(n, int((tile_bytes/(d*X.element_size()))**0.5)))
+    tiles = [slice(i, min(i+tile, n)) for i in range(0, n, tile)]
+    paqdiag = (X*torch.log(X+1e-4)).sum(1)
+    cross = torch.empty(n, n, dtype=X.dtype, device=X.device)
+
+    def cross_term(t_i, t_j):
+        paq = X[t_i, :, None] + X.T[None, :, t_j]
+        block = (paq*torch.log(paq/2+1e-4)).sum(1)
+        cross[t_i, t_j] = block
+        cross[t_j, t_i] = block.T
+
+    pairs = [(t_i, t_j) for i, t_i in enumerate(tiles) for t_j in tiles[i:]]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(lambda p: cross_term(*p), pairs))
+    return 1/2*(paqdiag[:, None]+paqdiag[None, :]-cross)
+
+
+def mat_discorr_sketch_adjacency(X: torch.tensor, tol: float = SKETCH_TOL, max_samples: int = None, seed: int = 0,
+                                 return_error: bool = False, max_mem_mb: int = DCOR_MEM_MB):
+    """
+    Approximate distance-correlation matrix of all row vectors in X. The Gram entry sum_{i,j} A_{i,j} B_{i,j} is
+    estimated from the entries of the double-centred distance matrices at m index pairs (i, j) drawn uniformly, a
+    sampling sketch of the d*d matrices that is unbiased and comes with the variance of every Gram entry. The centred
+    entries only need the row sums of the distance matrices, which take one sort per neuron.
+    m starts at SKETCH_INIT and grows until the estimated error is below tol, at least doubling and otherwise by the
+    1/sqrt(m) decay of the error. The error is the root mean square, over neuron pairs, of the standard error of their
+    distance correlation (delta method). Once m would reach a quarter of the d*d entries, about the cost of the exact
+    Gram matrix, the exact matrix of mat_discorr_adjacency is returned instead. The sampled entries are processed in
+    chunks bounded by max_mem_mb.
+    Input args:
+        X (torch.tensor). n*d. n is the number of neurons and d is the feature dimension.
+        tol (float). Target error of the distance correlations.
+        max_samples (int). Optional. Upper bound of m, the last estimate is returned when it is reached.
+        seed (int). Seed of the sampled index pairs.
+        return_error (bool). Also return the error estimate.
+        max_mem_mb (int). Memory cap of the sampled entries, and of the exact fallback.
+    Return:
+        pd (torch.tensor). n*n approximate distance correlation matrix
+        error (Dict). Only if return_error. 'rmse' and 'max' of the estimated standard errors, and 'samples' m
+    """
+    n, d = X.shape
+    X_in = X
+    X = X.double()
+    row_mean = _distance_row_sums(X)[0]/d
+    grand_mean = row_mean.mean(1, keepdim=True)
+    max_samples = max_samples or d*d
+    generator = torch.Generator(device=X.device).manual_seed(seed)
+
+    def centred(i, j):
+        return (X[:, i]-X[:, j]).abs()-row_mean[:, i]-row_mean[:, j]+grand_mean
+
+    # Running sums of a_p*a_q and (a_p*a_q)^2 over the sampled entries
+    prod_sum = torch.zeros(n, n, dtype=X.dtype, device=X.device)
+    sq_sum = torch.zeros(n, n, dtype=X.dtype, device=X.device)
+    # The centred entries, their squares and temporaries of one chunk
+    chunk = max(1, int(max_mem_mb*2**20)//(4*n*X.element_size()))
+    m, step = 0, SKETCH_INIT
+    while True:
+        step = min(step, max_samples-m)
+        if 4*(m+step)>=d*d:
+            pd = mat_discorr_adjacency(X_in, max_mem_mb=max_mem_mb)
+            return (pd, {'rmse': 0., 'max': 0., 'samples': d*d}) if return_error else pd
+        i, j = torch.randint(0, d, (2, step), generator=generator, device=X.device)
+        for c in range(0, step, chunk):
+            a = centred(i[c:c+chunk], j[c:c+chunk])
+            prod_sum += a@a.T
+            sq_sum += (a*a)@(a*a).T
+        m += step
+        gram = prod_sum/m
+        # Standard error of the Gram estimate and its effect on sqrt(G_pq)/(G_pp*G_qq)^(1/4)
+        se = ((sq_sum/m-gram**2).clamp(min=0)/m).sqrt()
+        diag = torch.diagonal(gram).clamp(min=1e-30)
+        se_corr = se/(2*torch.maximum(gram, se).clamp(min=1e-30).sqrt()*(diag[:, None]*diag[None, :])**0.25)
+        se_corr = se_corr[~torch.eye(n, dtype=torch.bool, device=X.device)]
+        error = {'rmse': se_corr.pow(2).mean().sqrt().item() if n>1 else 0., 'max': se_corr.max().item() if n>1 else 0., 'samples': m}
+        if error['rmse']<=tol or m>=max_samples:
+            break
+        step = max(m, int(m*(error['rmse']/tol)**2)-m)
+    pd = discorr_from_gram(gram.clamp(min=0).to(X_in.dtype), n)
+    return (pd, error) if return_error else pd
+
+
+@dataclass
+class CorrMetric:
+    """
+    Correlation metric of the neural activation graph, see CORR_METRICS.
+        fn (Callable): fn(X, psf_config) of the n*d activations, returns the n*n matrix, or the matrix and an error
+            estimate for approximate metrics
+        transform (str): applied to the standardized activations first, None or 'softmax'
+        filtration (str): turns the matrix into the distances of the filtration, 'one_minus' (1-x) or 'neg_log'
+            (-log(x+1e-6))
+        dtype (torch.dtype): dtype the activations are cast to
+        device (str): 'input' runs where the activations are, 'cuda' moves them to the gpu when there is one.
+            psf_config['corr_device'] overrides both
+        threaded (bool): runs its own pool of psf_config['corr_threads'] threads, otherwise psf_config['corr_threads']
+            bounds the intra-op (BLAS) threads of torch while it runs
+        moments (Callable): Optional. moments(stream) finalizes the same matrix from a StreamingCorrelation of the
+            prepared activations, so metrics computed together share its Gram matrix, see compute_corr_metrics
+    """
+    fn: Callable
+    transform: str = None
+    filtration: str = 'one_minus'
+    dtype: torch.dtype = torch.float32
+    device: str = 'input'
+    threaded: bool = False
+    moments: Callable = None
+
+    def prepare_key(self, X: torch.tensor, psf_config: Dict)-> Tuple:
+        """
+        Device, dtype and transform of the prepared activations, metrics with the same key share them.
+        """
+        device = psf_config.get('corr_device')
+        if device is None:
+            device = 'cuda' if self.device=='cuda' and torch.cuda.is_available() else X.device
+        return torch.device(device), self.dtype, self.transform
+
+    def prepare(self, X: torch.tensor, psf_config: Dict)-> torch.tensor:
+        """
+        Activations moved, cast and transformed as fn expects them.
+        """
+        device, dtype, transform = self.prepare_key(X, psf_config)
+        X = X.to(device=device, dtype=dtype)
+        if transform=='softmax':
+            X = torch.softmax(X, 1)
+        return X
+
+    def compute(self, X: torch.tensor, psf_config: Dict, prepared: torch.tensor = None, stream: 'StreamingCorrelation' = None)-> Tuple[torch.tensor, Dict]:
+        """
+        Correlation matrix of the row vectors of X on cpu, and the error estimate of approximate metrics (else None).
+        The prepared activations and, for metrics with moments, their StreamingCorrelation can be passed in when they
+        are shared with other metrics.
+        """
+        if prepared is None:
+            prepared = self.prepare(X, psf_config)
+        n_threads = torch.get_num_threads()
+        if psf_config.get('corr_threads') and not self.threaded:
+            torch.set_num_threads(psf_config['corr_threads'])
+        try:
+            out = self.moments(stream) if stream is not None and self.moments is not None else self.fn(prepared, psf_config)
+        finally:
+            torch.set_num_threads(n_threads)
+        pd, error = out if isinstance(out, tuple) else (out, None)
+        return pd.detach().cpu(), error
+
+    def distance(self, pd: torch.tensor)-> np.array:
+        """
+        Distance matrix of the filtration.
+        """
+        pd = pd.numpy()
+        return -np.log(pd+1e-6) if self.filtration=='neg_log' else 1-pd
+
+
+# Correlation metrics selectable by psf_config['corr_method']. New metrics are plugged in by adding a CorrMetric here
+CORR_METRICS = {
+    'distcorr': CorrMetric(lambda X, cfg: mat_discorr_adjacency(X, max_mem_mb=cfg.get('dcor_mem_mb', DCOR_MEM_MB))),
+    'distcorr_fast': CorrMetric(lambda X, cfg: mat_discorr_fast_adjacency(X, n_threads=cfg.get('corr_threads')), threaded=True),
+    'distcorr_sketch': CorrMetric(lambda X, cfg: mat_discorr_sketch_adjacency(X, cfg.get('sketch_tol', SKETCH_TOL), seed=cfg.get('sample_seed', 0),
+                                                                              return_error=True, max_mem_mb=cfg.get('dcor_mem_mb', DCOR_MEM_MB))),
+    'bc': CorrMetric(lambda X, cfg: mat_bc_adjacency(X), transform='softmax', filtration='neg_log', device='cuda'),
+    'cos': CorrMetric(lambda X, cfg: mat_cos_adjacency(X), device='cuda', moments=StreamingCorrelation.cos),
+    'pearson': CorrMetric(lambda X, cfg: mat_pearson_adjacency(X), device='cuda', moments=StreamingCorrelation.pearson),
+    'js': CorrMetric(lambda X, cfg: mat_jsdiv_adjacency(X, cfg.get('dcor_mem_mb', DCOR_MEM_MB), cfg.get('corr_threads')), transform='softmax', threaded=True),
+}
+
+
+def get_corr_metric(psf_config: Dict)-> CorrMetric:
+    """
+    Correlation metric selected by psf_config['corr_method'].
+    """
+    method = psf_config['corr_method']
+    if method not in CORR_METRICS:
+        raise Exception(f"Correlation metrics {method} doesn't implemented ! Choose from {list(CORR_METRICS)}")
+    return CORR_METRICS[method]
+
+
+def get_corr_methods(psf_config: Dict)-> List[str]:
+    """
+    Metrics computed from one probing pass, psf_config['corr_method'] first followed by psf_config['corr_methods'].
+    """
+    methods = list(dict.fromkeys([psf_config['corr_method']]+list(psf_config.get('corr_methods') or [])))
+    for method in methods:
+        get_corr_metric({'corr_method': method})
+    return methods
+
+
+def compute_corr_metrics(X: torch.tensor, methods: List[str], psf_config: Dict)-> Dict:
+    """
+    Correlation matrices of several metrics of the same activations. Metrics with the same device, dtype and transform
+    share the prepared activations, and those with moments (Pearson, cosine) are finalized from one
+    StreamingCorrelation, i.e. one centred Gram matrix.
+    Input args:
+        X (torch.tensor): n*d standardized activations
+        methods (List): Names of CORR_METRICS
+        psf_config (Dict): PSF configuration
+    Return:
+        Dictionary of method to the (matrix, error estimate) pair of CorrMetric.compute
+    """
+    if len(methods)==1:
+        return {methods[0]: get_corr_metric({'corr_method': methods[0]}).compute(X, psf_config)}
+    prepared = {}
+    streams = {}
+    out = {}
+    for method in methods:
+        metric = CORR_METRICS[method]
+        key = metric.prepare_key(X, psf_config)
+        if key not in prepared:
+            prepared[key] = metric.prepare(X, psf_config)
+        stream = None
+        if metric.moments is not None:
+            if key not in streams:
+                streams[key] = StreamingCorrelation(len(X), device=key[0], dtype=key[1]).update(prepared[key])
+            stream = streams[key]
+        out[method] = metric.compute(X, psf_config, prepared=prepared[key], stream=stream)
+    return out
@@ -4,13 +4,18 @@
 # @Author  : Songzhu Zheng (imzszhahahaha@gmail.com)
 # @Link    : https://songzhu-academic-site.netlify.app/
 
-import copy
+import os
+import queue
+import contextlib
+import functools
+import multiprocessing
+from multiprocessing import shared_memory
 from collections import defaultdict
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple
 
 import torch
 import numpy as np
-from ripser import Rips
+from ripser import ripser
 from scipy import sparse
 from scipy.sparse.csr import csr_matrix
 import time
@@ -19,56 +24,126 @@ import pickle
 import logging
 logging.basicConfig(level=logging.INFO)
 
-from topo_utils import mat_bc_adjacency, parse_arch, feature_collect, sample_act, mat_discorr_adjacency, mat_cos_adjacency, mat_jsdiv_adjacency, mat_pearson_adjacency
+from topo_utils import get_corr_metric, get_corr_methods, compute_corr_metrics, parse_arch, select_layers, sample_act, make_sample_plan
+from probe_utils import ProbeJob, PSFProbeScheduler, StackedProbeScheduler, AdaptiveStimSearch
 
+# Number of positions on which a reduced precision run is checked against fp32
+PRECISION_CHECK = 4
+# Adaptive scan: side of the first coarse cells in PSF steps, and the confidence change above which a cell is refined
+COARSE_FACTOR = 4
+REFINE_THRESHOLD = 0.05
+# Insertion radius below which the furthest point sampling of the sparse filtration stops, None samples all points
+GREEDY_CUTOFF = None
+# Rows of the distance matrix the sparse edge builders scan at once
+EDGE_BLOCK = 256
+# Highest homology dimension of the persistent diagrams, 0 computes them with h0_diagram instead of ripser
+MAXDIM = 1
+# Filtration planner, see plan_filtration. Without a time budget graphs of at most EXACT_MAX_NEURONS neurons get the
+# exact filtration and larger ones the sparse one with SPARSE_EPS, with a budget eps is the smallest of the ladder
+# that fits. PH_COST is the ripser time (s) per edge and neuron of a maxdim 1 diagram
+FILTRATION = 'auto'
+EXACT_MAX_NEURONS = 500
+SPARSE_EPS = 0.1
+SPARSE_EPS_LADDER = [0.1, 0.2, 0.5, 1.0, 2.0]
+PH_COST = 3e-8
+# Persistent homology worker processes, see PHWorkerPool. 0 computes the diagrams in the extracting process
+PH_WORKERS = 0
+PH_START_METHOD = 'forkserver'
 
-def makeSparseDM(D: np.array, threshold: float)-> np.array:
+
+class CooBuilder:
+    """
+    COO arrays that the edges of a sparse distance matrix are appended to block by block. They grow geometrically, so
+    the memory held stays proportional to the number of kept edges.
+    Input args:
+        dtype (np.dtype): dtype of the edge weights
+        capacity (int): Initial number of edges
+    """
+
+    def __init__(self, dtype: np.dtype, capacity: int = 1024):
+        self.I = np.empty(capacity, dtype=np.int64)
+        self.J = np.empty(capacity, dtype=np.int64)
+        self.V = np.empty(capacity, dtype=dtype)
+        self.n = 0
+
+    def add(self, I: np.array, J: np.array, V: np.array):
+        n = self.n+len(I)
+        if n>len(self.I):
+            capacity = max(n, 2*len(self.I))
+            for name in ['I', 'J', 'V']:
+                buf = np.empty(capacity, dtype=getattr(self, name).dtype)
+                buf[:self.n] = getattr(self, name)[:self.n]
+                setattr(self, name, buf)
+        self.I[self.n:n] = I
+        self.J[self.n:n] = J
+        self.V[self.n:n] = V
+        self.n = n
+
+    def tocsr(self, N: int)-> csr_matrix:
+        return sparse.coo_matrix((self.V[:self.n], (self.I[:self.n], self.J[:self.n])), shape=(N, N)).tocsr()
+
+
+def makeSparseDM(D: np.array, threshold: float, block: int = EDGE_BLOCK)-> np.array:
     """
     Convert a dense matrix to COO format. All values that are below thresh are set to be 0.
     Input args:
         D (np.array): matrix to be converted
         threshold (float): threshold below which value will be set to 0
+        block (int): Number of rows scanned at once
     Return:
         matrix in compressed sparse column format
     """
     N = D.shape[0]
-    [I, J] = np.meshgrid(np.arange(N), np.arange(N))
-    I = I[D <= threshold]
-    J = J[D <= threshold]
-    V = D[D <= threshold]
-    return sparse.coo_matrix((V, (I, J)), shape=(N, N)).tocsr()
+    coo = CooBuilder(D.dtype)
+    for r0 in range(0, N, block):
+        sub = D[r0:r0+block]
+        J, I = np.nonzero(sub <= threshold)
+        coo.add(I, J+r0, sub[J, I])
+    return coo.tocsr(N)
 
 
-def getGreedyPerm(D: np.array)-> List:
+def getGreedyPerm(D: np.array, cutoff: float = None)-> np.array:
     """
-    A Naive O(N^2) algorithm to do furthest points sampling
+    A Naive O(N^2) algorithm to do furthest points sampling. Every pick depends on the previous one, so the N picks
+    remain a Python loop around the O(N) numpy distance update and dominate for large N; the cutoff shortens it
     Input args:
         D (np.array):  An NxN distance matrix for points
+        cutoff (float): Optional. Stop once the insertion radius falls to cutoff. The points not sampled by then are
+            appended by decreasing distance to the sampled set, which stands in for their radius and is at most cutoff
     Return:
-        lamdas (List): list Insertion radii of all points
+        lamdas (np.array): Insertion radii of all points
     """
-
     N = D.shape[0]
     # By default, takes the first point in the permutation to be the
     # first point in the point cloud, but could be random
     perm = np.zeros(N, dtype=np.int64)
     lambdas = np.zeros(N)
-    ds = D[0, :]
+    # Distances to the sampled set, updated in place
+    ds = D[0, :].copy()
     for i in range(1, N):
-        idx = np.argmax(ds)
+        idx = ds.argmax()
+        if cutoff is not None and ds[idx]<=cutoff:
+            order = np.argsort(-ds, kind='stable')[:N-i]
+            # Once every point is sampled the argmax falls back to the first point
+            order[ds[order]==0] = 0
+            perm[i:] = order
+            lambdas[i:] = ds[order]
+            break
         perm[i] = idx
         lambdas[i] = ds[idx]
-        ds = np.minimum(ds, D[idx, :])
+        np.minimum(ds, D[idx, :], out=ds)
     return lambdas[perm]
 
 
-def getApproxSparseDM(lambdas: List, eps: float, D: np.array)-> csr_matrix:
+def getApproxSparseDM(lambdas: List, eps: float, D: np.array, block: int = EDGE_BLOCK)-> csr_matrix:
     """
-    Purpose: To return the sparse edge list with the warped distances, sorted by weight.
+    Purpose: To return the sparse edge list with the warped distances, sorted by weight. The lower triangle of D is
+    scanned block rows at a time and only the kept edges are stored.
     Input args:
         lambdas (List): insertion radii for points
         eps (float): epsilon approximation constant
-        D (np.array): NxN distance matrix, okay to modify because last time it's used
+        D (np.array): NxN distance matrix, left unchanged
+        block (int): Number of rows scanned at once
     Return:
         DSparse (scipy.sparse): A sparse NxN matrix with the reweighted edges
     """
@@ -80,38 +155,325 @@ def getApproxSparseDM(lambdas: List, eps: float, D: np.array)-> csr_matrix:
     # Search neighborhoods
     nBounds = ((eps**2+3*eps+2)/eps)*lambdas
 
-    # Set all distances outside of search neighborhood to infinity
-    D[D > nBounds[:, None]] = np.inf
-    [I, J] = np.meshgrid(np.arange(N), np.arange(N))
-    idx = I < J
-    I = I[(D < np.inf)*(idx == 1)]
-    J = J[(D < np.inf)*(idx == 1)]
-    D = D[(D < np.inf)*(idx == 1)]
+    coo = CooBuilder(D.dtype)
+    for r0 in range(0, N, block):
+        r1 = min(r0+block, N)
+        # Pairs (j, i) with i < j whose distance is within the search neighborhood of j
+        sub = D[r0:r1, :r1]
+        J, I = np.nonzero((sub <= nBounds[r0:r1, None]) & (np.arange(r1)[None, :] < np.arange(r0, r1)[:, None]))
+        d = sub[J, I]
+        J += r0
+
+        #Prune sparse list and update warped edge lengths (Algorithm 3 pg. 14)
+        minlam = np.minimum(lambdas[I], lambdas[J])
+        maxlam = np.maximum(lambdas[I], lambdas[J])
+
+        # Rule out edges between vertices whose balls stop growing before they touch
+        # or where one of them would have been deleted.  M stores which of these
+        # happens first
+        M = np.minimum((E0 + E1)*minlam, E0*(minlam + maxlam))
+
+        t = d <= M
+        (I, J, d) = (I[t], J[t], d[t])
+        minlam = minlam[t]
+
+        # If cones haven't turned into cylinders, metric is unchanged
+        # Otherwise, if they meet before the M condition above, the metric is warped
+        t = ~(d <= 2*minlam*E0)
+        d[t] = 2.0*(d[t] - minlam[t]*E0) # Multiply by 2 convention
+        coo.add(I, J, d)
+    return coo.tocsr(N)
+
+
+def plan_filtration(D: np.array, psf_config: Dict)-> Dict:
+    """
+    Choose the filtration the persistent diagrams are computed on from a distance matrix: 'exact' is the full Rips
+    filtration, 'sparse' the approximate sparse one of getApproxSparseDM and 'threshold' the Rips filtration stopped
+    at a distance. With psf_config['ph_time_budget'] (s per position and metric) the most faithful filtration whose
+    estimated ripser time fits is chosen, the sparse one with the smallest eps of SPARSE_EPS_LADDER that fits,
+    otherwise the threshold keeping as many edges as fit. psf_config['filtration'] forces the kind.
+    Input args:
+        D (np.array): NxN distance matrix
+        psf_config (Dict): PSF configuration
+    Return:
+        filtration_plan (Dict):
+            'filtration' (str): exact, sparse or threshold
+            'eps' (float): epsilon of the sparse filtration, None otherwise
+            'thresh' (float): distance the filtration stops at, inf unless threshold
+            'n_neurons' (int): N
+            'edge_density' (float): fraction of the N(N-1)/2 edges in the filtration
+            'est_time' (float): estimated ripser time (s)
+    """
+    kind=psf_config.get('filtration', FILTRATION)
+    budget=psf_config.get('ph_time_budget')
+    if kind not in ['auto', 'exact', 'sparse', 'threshold']:
+        raise Exception(f"Unknown filtration {kind}, choose from auto, exact, sparse or threshold")
+    N=D.shape[0]
+    n_edges=max(N*(N-1)//2, 1)
+    edge_cost=psf_config.get('ph_cost', PH_COST)*N
+    max_edges=np.inf if budget is None else budget/edge_cost
+    plan={'filtration': 'exact', 'eps': None, 'thresh': np.inf, 'n_neurons': N, 'edge_density': 1.0, 'est_time': edge_cost*n_edges}
+    # The spanning tree engine of maxdim 0 is cheaper than building any sparse filtration
+    if kind=='exact' or (kind=='auto' and psf_config.get('maxdim', MAXDIM)==0):
+        return plan
+    if kind=='auto' and (N<=EXACT_MAX_NEURONS if budget is None else n_edges<=max_edges):
+        return plan
+    if kind in ['auto', 'sparse']:
+        lambdas=getGreedyPerm(D, psf_config.get('greedy_cutoff', GREEDY_CUTOFF))
+        ladder=[SPARSE_EPS] if budget is None else SPARSE_EPS_LADDER
+        for eps in ladder:
+            nnz=getApproxSparseDM(lambdas, eps, D).nnz
+            if nnz<=max_edges or (kind=='sparse' and eps==ladder[-1]):
+                return dict(plan, filtration='sparse', eps=eps, edge_density=nnz/n_edges, est_time=edge_cost*nnz)
+    if budget is None:
+        raise Exception("A threshold filtration needs psf_config['ph_time_budget']")
+    upper=D[np.triu_indices(N, 1)]
+    k=int(min(max_edges, len(upper)))
+    thresh=float(np.partition(upper, k-1)[k-1]) if k else 0.0
+    # Ties at the threshold are kept as well
+    k=int(np.count_nonzero(upper<=thresh))
+    return dict(plan, filtration='threshold', thresh=thresh, edge_density=k/n_edges, est_time=edge_cost*k)
+
+
+def h0_diagram(D, thresh: float = np.inf)-> np.array:
+    """
+    Dimension 0 persistent diagram of the Rips filtration of D, as ripser would return it. The merges of connected
+    components are the edges of a minimum spanning forest, found with Prim's algorithm in O(N^2), and paired with the
+    elder rule by a union-find in increasing edge order.
+    Input args:
+        D (np.array or scipy.sparse): NxN distance matrix. As in ripser only the entries above the diagonal are edges,
+            and the diagonal, if any entry of it is nonzero, holds the birth times of the points
+        thresh (float): Edges longer than thresh are left out
+    Return:
+        k*2 array of (birth, death) pairs of increasing death, followed by one (birth, inf) pair per component
+    """
+    N = D.shape[0]
+    if not sparse.issparse(D) and np.any(D.diagonal()!=0):
+        # ripser handles nonzero births through its sparse format, which drops the zero distances
+        D = sparse.coo_matrix(D)
+    W = np.full((N, N), np.inf, dtype=np.float32)
+    if sparse.issparse(D):
+        D = D.tocoo()
+        births = np.zeros(N, dtype=np.float32)
+        births[D.row[D.row==D.col]] = D.data[D.row==D.col]
+        upper = D.row<D.col
+        W[D.row[upper], D.col[upper]] = D.data[upper]
+        W[D.col[upper], D.row[upper]] = D.data[upper]
+    else:
+        births = np.zeros(N, dtype=np.float32)
+        upper = np.triu(np.ones((N, N), dtype=bool), 1)
+        W[upper] = D[upper]
+        W.T[upper] = D[upper]
+    W[W>thresh] = np.inf
+
+    # Prim's algorithm, a new tree is started from the first unreached point whenever no edge leaves the current ones
+    in_tree = np.zeros(N, dtype=bool)
+    dist = np.full(N, np.inf, dtype=np.float32)
+    parent = np.full(N, -1)
+    edges = []
+    for _ in range(N):
+        i = int(np.argmin(np.where(in_tree, np.inf, dist)))
+        if in_tree[i] or dist[i]==np.inf:
+            i = int(np.argmin(in_tree))
+        else:
+            edges.append((dist[i], parent[i], i))
+        in_tree[i] = True
+        closer = (W[i]<dist) & ~in_tree
+        dist[closer] = W[i][closer]
+        parent[closer] = i
+
+    # Elder rule, the younger of two merging components dies
+    root = np.arange(N)
+    def find(x):
+        while root[x]!=x:
+            root[x] = root[root[x]]
+            x = root[x]
+        return x
+    pairs = []
+    for death, u, v in sorted(edges, key=lambda e: e[0]):
+        u, v = find(u), find(v)
+        birth = max(births[u], births[v])
+        if death>birth:
+            pairs.append((birth, death))
+        if births[u]>births[v]:
+            u, v = v, u
+        root[v] = u
+    pairs += [(births[i], np.inf) for i in range(N) if find(i)==i]
+    return np.array(pairs, dtype=np.float64).reshape(-1, 2)
+
+
+def topo_feature(D: np.array, plan: Dict, maxdim: int = MAXDIM, greedy_cutoff: float = None)-> Tuple[List, torch.tensor]:
+    """
+    Persistent diagram of distance matrix D on the filtration of plan (see plan_filtration) and its 12 topological
+    features.
+    """
+    # Approaximate sparse filtration to further save some computation
+    if plan['filtration']=='sparse':
+        lambdas=getGreedyPerm(D, greedy_cutoff)
+        D = getApproxSparseDM(lambdas, plan['eps'], D)
+        # sparse_PD_list.append(D)
+    if maxdim==0:
+        # Only the connected components are needed, the dimension 1 features stay zero
+        PH=[h0_diagram(D, plan['thresh']), np.zeros((0, 2))]
+    else:
+        PH=ripser(D, maxdim=maxdim, thresh=plan['thresh'], distance_matrix=True)['dgms']
+
+    PH[0]=np.array(PH[0])
+    PH[1]=np.array(PH[1])
+    PH[0][np.where(PH[0]==np.inf)]=1
+    PH[1][np.where(PH[1]==np.inf)]=1
 
-    #Prune sparse list and update warped edge lengths (Algorithm 3 pg. 14)
-    minlam = np.minimum(lambdas[I], lambdas[J])
-    maxlam = np.maximum(lambdas[I], lambdas[J])
+    # Compute the topological feature with the persistent diagram
+    clean_feature_0=calc_topo_feature(PH, 0)
+    clean_feature_1=calc_topo_feature(PH, 1)
+    topo_feature=[]
+    for k in sorted(list(clean_feature_0)):
+        topo_feature.append(clean_feature_0[k])
+    for k in sorted(list(clean_feature_1)):
+        topo_feature.append(clean_feature_1[k])
+    return PH, torch.tensor(topo_feature)
 
-    # Rule out edges between vertices whose balls stop growing before they touch
-    # or where one of them would have been deleted.  M stores which of these
-    # happens first
-    M = np.minimum((E0 + E1)*minlam, E0*(minlam + maxlam))
 
-    t = np.arange(len(I))
-    t = t[D <= M]
-    (I, J, D) = (I[t], J[t], D[t])
-    minlam = minlam[t]
-    maxlam = maxlam[t]
+def ph_worker(tasks: multiprocessing.Queue, results: multiprocessing.Queue):
+    """
+    Loop of a PHWorkerPool process: attach the shared distance matrix of a task, compute its topo_feature and send
+    it back with the task number, until a None task arrives.
+    """
+    while True:
+        task=tasks.get()
+        if task is None:
+            return
+        seq, name, shape, dtype, args=task
+        shm=shared_memory.SharedMemory(name=name)
+        try:
+            PH, feature=topo_feature(np.ndarray(shape, dtype=dtype, buffer=shm.buf), *args)
+            out=(PH, feature.numpy())
+        except Exception as e:
+            out=e
+        finally:
+            shm.close()
+        results.put((seq, out))
+
+
+class PHWorkerPool:
+    """
+    Consumer stage of the extraction. The producer (probing and correlation) submits distance matrices, which are
+    handed over in shared memory through a bounded queue to processes computing their persistent diagrams. A full
+    queue blocks the producer instead of letting it run ahead, and the results are handed to their callbacks in
+    submission order.
+    Input args:
+        n_workers (int): Number of worker processes
+        queue_depth (int): Distance matrices waiting for a worker at most, default to 2*n_workers
+        start_method (str): multiprocessing start method of the workers
+    """
+
+    def __init__(self, n_workers: int, queue_depth: int = None, start_method: str = PH_START_METHOD):
+        ctx=multiprocessing.get_context(start_method)
+        self.tasks=ctx.Queue(maxsize=queue_depth or 2*n_workers)
+        self.results=ctx.Queue()
+        self.workers=[ctx.Process(target=ph_worker, args=(self.tasks, self.results), daemon=True) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.seq=0
+        # Submitted tasks by number: shared block and callback, and finished ones waiting for an earlier task
+        self.pending={}
+        self.done={}
+        self.next=0
+        self.stats={'submitted': 0, 'max_in_flight': 0, 'max_queued': 0, 'producer_wait': 0.0, 'drain_wait': 0.0}
+
+    def depths(self)-> Dict:
+        """
+        Current depths: distance matrices waiting for a worker, submitted but not delivered, and finished but waiting
+        for an earlier one.
+        """
+        return {'queued': self.tasks.qsize(), 'in_flight': len(self.pending)+len(self.done), 'reorder': len(self.done)}
 
-    # Now figure out the metric of the edges that are actually added
-    t = np.ones(len(I))
+    def submit(self, D: np.array, args: Tuple, callback: Callable):
+        """
+        Queue topo_feature(D, *args), callback(PH, topo_feature) is called once it and every earlier task are done.
+        """
+        shm=shared_memory.SharedMemory(create=True, size=max(D.nbytes, 1))
+        np.ndarray(D.shape, dtype=D.dtype, buffer=shm.buf)[:]=D
+        self.pending[self.seq]=(shm, callback)
+        t0=time.time()
+        self.tasks.put((self.seq, shm.name, D.shape, D.dtype.str, args))
+        self.stats['producer_wait']+=time.time()-t0
+        self.seq+=1
+        self.stats['submitted']+=1
+        depths=self.depths()
+        self.stats['max_in_flight']=max(self.stats['max_in_flight'], depths['in_flight'])
+        self.stats['max_queued']=max(self.stats['max_queued'], depths['queued'])
+        self.collect()
 
-    # If cones haven't turned into cylinders, metric is unchanged
-    t[D <= 2*minlam*E0] = 0
+    def collect(self, timeout: float = 0):
+        """
+        Deliver the finished results, waiting up to timeout (s) for the first one.
+        """
+        while self.pending:
+            try:
+                seq, out=self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise Exception("a persistent homology worker died")
+                return
+            timeout=0
+            shm, callback=self.pending.pop(seq)
+            shm.close()
+            shm.unlink()
+            self.done[seq]=(callback, out)
+            while self.next in self.done:
+                callback, out=self.done.pop(self.next)
+                if isinstance(out, Exception):
+                    raise Exception(f"persistent diagram of task {self.next} failed") from out
+                callback(*out)
+                self.next+=1
 
-    # Otherwise, if they meet before the M condition above, the metric is warped
-    D[t == 1] = 2.0*(D[t == 1] - minlam[t == 1]*E0) # Multiply by 2 convention
-    return sparse.coo_matrix((D, (I, J)), shape=(N, N)).tocsr()
+    def drain(self):
+        """
+        Wait for and deliver every submitted task.
+        """
+        t0=time.time()
+        while self.pending:
+            self.collect(timeout=1)
+        self.stats['drain_wait']+=time.time()-t0
+
+    def close(self, terminate: bool = False):
+        """
+        Stop the workers once they are done with the queued tasks, or right away with terminate, and free the shared
+        blocks of the tasks that were never delivered.
+        """
+        for worker in self.workers:
+            if terminate:
+                worker.terminate()
+            else:
+                self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        for shm, _ in self.pending.values():
+            shm.close()
+            shm.unlink()
+        self.pending={}
+        self.done={}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # A failed extraction does not wait for the diagrams nobody will collect
+        self.close(terminate=exc_type is not None)
+
+
+def make_ph_pool(psf_config: Dict):
+    """
+    Context of a PHWorkerPool of psf_config['ph_workers'] processes, entering it gives None when the diagrams are
+    computed in process. Daemonic processes, e.g. multiprocessing.Pool workers, can not start the pool and compute
+    in process too.
+    """
+    n_workers=psf_config.get('ph_workers', PH_WORKERS)
+    if n_workers and multiprocessing.current_process().daemon:
+        logging.warning(f"{multiprocessing.current_process().name} is daemonic and can not start {n_workers} persistent homology workers, computing in process")
+        n_workers=0
+    return PHWorkerPool(n_workers, psf_config.get('ph_queue_depth')) if n_workers else contextlib.nullcontext()
 
 
 def calc_topo_feature(PH: List, dim: int)-> Dict:
@@ -142,6 +504,446 @@ def calc_topo_feature(PH: List, dim: int)-> Dict:
     return topo_feature_dict
 
 
+class PSFFeatureBuilder:
+    """
+    Turn the probe results of one model into PSF and topological features, one spatial position at a time.
+    Input args:
+        model (torch.nn.Module). Target model.
+        example_dict (Dict). Dictionary contains clean input examples.
+        psf_config (Dict). PSF configuration.
+        num_classes (int). Number of output classes of the model.
+        cache_dir (str). Optional. Folder the persistent diagrams are saved to.
+        ph_pool (PHWorkerPool). Optional. Pool the persistent diagrams are computed in, the features of a position
+            are filled in once it delivers them, see drain.
+    """
+
+    def __init__(self, model: torch.nn.Module, example_dict: Dict, psf_config: Dict, num_classes: int, cache_dir: str = None, ph_pool: PHWorkerPool = None):
+        self.model=model
+        self.psf_config=psf_config
+        self.cache_dir=cache_dir
+        self.ph_pool=ph_pool
+        input_shape=psf_config['input_shape']
+        patch_size=psf_config['patch_size']
+        step_size=psf_config['step_size']
+        # 2 represent score and conf
+        self.feature_map_h=len(range(0, input_shape[1]-patch_size+1, step_size))
+        self.feature_map_w=len(range(0, input_shape[2]-patch_size+1, step_size))
+        # PSF feature dim : 2*m*h*w*L*C
+        #  2: logits and confidence
+        #  m: numebr of input examples
+        #  h: feature map height
+        #  w: feature map width
+        #  L: number of stimulation levels
+        #  C: number of classes
+        self.psf_feature_pos=torch.zeros(
+            2,
+            len(example_dict.keys()),
+            self.feature_map_h, self.feature_map_w,
+            psf_config['stim_level'], num_classes)
+        # Every metric of psf_config['corr_methods'] gets its own topological features from the same activations,
+        # the attributes without prefix are the ones of psf_config['corr_method']
+        self.corr_methods=get_corr_methods(psf_config)
+        # 12 is the number of topological features (including dim1 and dim2 features)
+        self.metric_topo_feature_pos={method: torch.zeros(
+            len(example_dict.keys()),
+            len(range(0, int(self.feature_map_h*self.feature_map_w))),
+            12
+        ) for method in self.corr_methods}
+        self.topo_feature_pos=self.metric_topo_feature_pos[self.corr_methods[0]]
+        # Positions holding features, a time-budgeted run may stop before covering all of them
+        self.coverage_mask=torch.zeros(len(example_dict.keys()), self.feature_map_h, self.feature_map_w, dtype=torch.bool)
+        self.metric_PH_list={method: [] for method in self.corr_methods}
+        self.metric_PD_list={method: [] for method in self.corr_methods}
+        self.PH_list=self.metric_PH_list[self.corr_methods[0]]
+        self.PD_list=self.metric_PD_list[self.corr_methods[0]]
+        # Estimated errors of approximate correlation matrices, one per position
+        self.corr_error=[]
+        self.maxdim=psf_config.get('maxdim', MAXDIM)
+        # Filtration of every metric, see filtration_plan
+        self.filtration_plans={}
+        # The architecture does not change between positions, parse it once and keep the selected layers
+        layer_list, layer_k=parse_arch(model)
+        layer_ind=select_layers(model, psf_config)
+        self.layer_list=([layer_list[i] for i in layer_ind], [layer_k[i] for i in layer_ind])
+        self.sample_plan=self.load_sample_plan((layer_list, layer_k), layer_ind)
+
+    def load_sample_plan(self, layer_list: List, layer_ind: List)-> Dict:
+        """
+        Neurons sampled at every position. The plan is drawn once per model and kept in the cache folder, so reruns
+        sample the same neurons.
+        """
+        n_neuron_sample=self.psf_config['n_neuron']
+        plan_file=f"{self.cache_dir}/sample_plan.pkl" if self.cache_dir else None
+        if plan_file and os.path.exists(plan_file):
+            with open(plan_file, "rb") as f:
+                sample_plan=pickle.load(f)
+            f.close()
+            if sample_plan is None or (sample_plan['layer_ind']==layer_ind and sample_plan['sample_size']==n_neuron_sample):
+                return sample_plan
+            logging.warning(f"sample plan in {plan_file} was drawn for another configuration, drawing a new one")
+        sample_plan=make_sample_plan(layer_list, layer_ind, n_neuron_sample, seed=self.psf_config.get('sample_seed', 0))
+        if plan_file:
+            with open(plan_file, "wb") as f:
+                pickle.dump(sample_plan, f)
+            f.close()
+        return sample_plan
+
+    def filtration_plan(self, method: str, D: np.array)-> Dict:
+        """
+        Filtration of the persistent diagrams of a metric, planned from its distance matrix at the first position (see
+        plan_filtration) and kept in the cache folder, so every position and rerun uses the same one.
+        """
+        if method in self.filtration_plans:
+            return self.filtration_plans[method]
+        config={k: self.psf_config.get(k, default) for k, default in [('filtration', FILTRATION), ('ph_time_budget', None), ('maxdim', MAXDIM)]}
+        plan_file=f"{self.cache_dir}/filtration_plan.pkl" if self.cache_dir else None
+        plans={}
+        if plan_file and os.path.exists(plan_file):
+            with open(plan_file, "rb") as f:
+                plans=pickle.load(f)
+            f.close()
+        plan=plans.get(method)
+        if plan is None or plan['config']!=config or plan['n_neurons']!=len(D):
+            if plan is not None:
+                logging.warning(f"{method} filtration plan in {plan_file} was made for another configuration, planning again")
+            plan=dict(plan_filtration(D, self.psf_config), config=config)
+            plans[method]=plan
+            if plan_file:
+                with open(plan_file, "wb") as f:
+                    pickle.dump(plans, f)
+                f.close()
+        logging.info(f"{method} diagrams on the {plan['filtration']} filtration (eps {plan['eps']}, thresh {plan['thresh']:.3g}, "
+                     f"edge density {plan['edge_density']:.2f}, estimated {plan['est_time']:.2f}s per position)")
+        self.filtration_plans[method]=plan
+        return plan
+
+    def add(self, job: ProbeJob, pred: torch.tensor, layer_act_list: List):
+        """
+        Compute the features of one position from its L*C logits and its list of n_l*L layer activations.
+        """
+        n_neuron_sample=self.psf_config['n_neuron']
+        model=self.model
+        c, pos_w, pos_h=job.c, job.pos_w, job.pos_h
+        feature_w_pos, feature_h_pos=divmod(job.pos_ind, self.feature_map_w)
+        # Activation only runs have no logits, their PSF features stay zero
+        if pred.shape[1]:
+            psf_score=pred
+            psf_conf=torch.nn.functional.softmax(psf_score, 1)
+
+            self.psf_feature_pos[0, c, feature_w_pos, feature_h_pos]=psf_score
+            self.psf_feature_pos[1, c, feature_w_pos, feature_h_pos]=psf_conf
+
+        # Extract intermediate activating vectors
+        neural_act = []
+        for layer_act in layer_act_list:
+            # Standardize the activation layer-wisely
+            layer_act=(layer_act-layer_act.mean(1, keepdim=True))/(layer_act.std(1, keepdim=True)+1e-30)
+            neural_act.append(layer_act)
+        neural_act=torch.cat(neural_act)
+        sample_n_neurons_list=None
+        if self.sample_plan is not None:
+            # Only the planned neurons were recorded
+            sample_n_neurons_list=[len(x) for x in self.sample_plan['channels'] if len(x)]
+        elif len(neural_act)>1.5e3:
+            neural_act, sample_n_neurons_list=sample_act(neural_act, self.layer_list, sample_size=n_neuron_sample)
+
+        model_file = self.cache_dir.split('/')[-1] if self.cache_dir else model._get_name()
+        logging.info(f"building neural correlation matrix for {model_file} {pos_w} {pos_h}..")
+
+        # Build neural correlation matrix of every metric, see topo_utils.CORR_METRICS
+        D_list=[]
+        for method, (neural_pd, corr_error) in compute_corr_metrics(neural_act, self.corr_methods, self.psf_config).items():
+            if corr_error is not None:
+                self.corr_error.append(corr_error)
+            self.metric_PD_list[method].append(neural_pd.numpy())
+            D_list.append(get_corr_metric({'corr_method': method}).distance(neural_pd))
+        plans=[self.filtration_plan(method, D) for method, D in zip(self.corr_methods, D_list)]
+        greedy_cutoff=self.psf_config.get('greedy_cutoff', GREEDY_CUTOFF)
+        for method, D, plan in zip(self.corr_methods, D_list, plans):
+            commit=functools.partial(self.commit, method, c, job.pos_ind)
+            if self.ph_pool is not None:
+                self.ph_pool.submit(D, (plan, self.maxdim, greedy_cutoff), commit)
+            else:
+                commit(*topo_feature(D, plan, self.maxdim, greedy_cutoff))
+        self.coverage_mask[c, feature_w_pos, feature_h_pos]=True
+
+    def commit(self, method: str, c: int, pos_ind: int, PH: List, feature):
+        """
+        Store the persistent diagram and topological features of a metric at a position.
+        """
+        self.metric_PH_list[method].append(PH)
+        self.metric_topo_feature_pos[method][c, pos_ind, :]=torch.as_tensor(feature)
+
+    def drain(self):
+        """
+        Wait for the persistent diagrams still computed by the pool, so that the features of every added position are
+        filled in.
+        """
+        if self.ph_pool is not None:
+            self.ph_pool.drain()
+
+    def finalize(self)-> Dict:
+        """
+        Save the persistent diagrams to the cache folder and return the feature dictionary.
+        """
+        self.drain()
+        if self.cache_dir:
+            with open(f"{self.cache_dir}/PH_list.pkl", "wb") as f:
+                pickle.dump(self.PH_list, f)
+            f.close()
+            for method in self.corr_methods[1:]:
+                with open(f"{self.cache_dir}/PH_list_{method}.pkl", "wb") as f:
+                    pickle.dump(self.metric_PH_list[method], f)
+                f.close()
+            # with open(f"{cache_dir}/PD_list.pkl", "wb") as f:
+            #     pickle.dump(PD_list, f)
+            # f.close()
+
+        fv={}
+        fv['psf_feature_pos']=self.psf_feature_pos
+        fv['topo_feature_pos']=self.topo_feature_pos
+        fv['correlation_matrix']=np.vstack([x[None, :, :] for x in self.PD_list]).mean(0)
+        fv['coverage_mask']=self.coverage_mask
+        fv['topo_feature_summary']=self.summary(self.topo_feature_pos)
+        if len(self.corr_methods)>1:
+            fv['metric_features']={method: {
+                'topo_feature_pos': self.metric_topo_feature_pos[method],
+                'topo_feature_summary': self.summary(self.metric_topo_feature_pos[method]),
+                'correlation_matrix': np.vstack([x[None, :, :] for x in self.metric_PD_list[method]]).mean(0),
+            } for method in self.corr_methods}
+        if self.corr_error:
+            # Screening runs re-extract the models whose error is too large with an exact metric
+            fv['corr_error']={
+                'rmse': max(x['rmse'] for x in self.corr_error),
+                'max': max(x['max'] for x in self.corr_error),
+                'samples': min(x['samples'] for x in self.corr_error),
+            }
+        return fv
+
+    def summary(self, topo_feature_pos: torch.tensor)-> Dict:
+        """
+        Statistics of the topological features over the covered positions of every input example.
+        """
+        covered=self.coverage_mask.flatten(1)
+        summary=defaultdict(list)
+        for c in range(len(covered)):
+            topo=topo_feature_pos[c, covered[c]]
+            if not len(topo):
+                topo=torch.zeros(1, topo_feature_pos.shape[2])
+            summary['mean'].append(topo.mean(0))
+            summary['std'].append(topo.std(0) if len(topo)>1 else torch.zeros_like(topo[0]))
+            summary['min'].append(topo.min(0)[0])
+            summary['max'].append(topo.max(0)[0])
+        summary={k: torch.stack(v) for k, v in summary.items()}
+        summary['coverage']=covered.float().mean(1)
+        return summary
+
+
+def scan_order(h: int, w: int, order: str, seed: int = 0)-> List[int]:
+    """
+    Order in which the positions of an h*w feature map are visited. 'raster' goes row by row, 'random' is a seeded
+    permutation and 'space_filling' visits the map coarse to fine, so that every prefix of the order spreads evenly
+    over it.
+    """
+    if order=='raster':
+        return list(range(h*w))
+    if order=='random':
+        return [int(i) for i in np.random.RandomState(seed).permutation(h*w)]
+    if order=='space_filling':
+        # Level of a position is the largest power of two dividing both its row and column
+        def level(i, j):
+            return min(i & -i if i else 1<<30, j & -j if j else 1<<30)
+        return sorted(range(h*w), key=lambda ind: (-level(*divmod(ind, w)), ind))
+    raise Exception(f"Unknown scan order {order}, choose from raster, random or space_filling")
+
+
+def psf_probe_jobs(example_dict: Dict, psf_config: Dict)-> List[ProbeJob]:
+    """
+    For each class input examples, scan through pixels with step_size and modify corresponding pixel with different
+    stimulation level. One ProbeJob holds all stimulation levels of one example at one position. Positions are
+    visited in psf_config['scan_order'] (see scan_order), the class examples of one position one after the other. The
+    order defaults to space_filling under a psf_config['time_budget'], so a scan cut short is spread over the input,
+    and to raster otherwise.
+    """
+    step_size=psf_config['step_size']
+    patch_size=psf_config['patch_size']
+    input_shape=psf_config['input_shape']
+    input_valuerange=psf_config['input_range']
+    stim_seq=np.linspace(input_valuerange[0], input_valuerange[1], psf_config['stim_level'])
+    rows=range(0, input_shape[1]-patch_size+1, step_size)
+    cols=range(0, input_shape[2]-patch_size+1, step_size)
+    positions=[(pos_w, pos_h) for pos_w in rows for pos_h in cols]
+    order=psf_config.get('scan_order')
+    if order is None:
+        order='space_filling' if psf_config.get('time_budget') else 'raster'
+    if order=='raster':
+        return [ProbeJob(c, pos_ind, pos_w, pos_h, stim_seq) for c in example_dict for pos_ind, (pos_w, pos_h) in enumerate(positions)]
+    return [ProbeJob(c, pos_ind, *positions[pos_ind], stim_seq) for pos_ind in scan_order(len(rows), len(cols), order, psf_config.get('sample_seed', 0))
+            for c in example_dict]
+
+
+def fill_uncovered(fv: Dict)-> Dict:
+    """
+    Feature dictionary in which the positions a time-budgeted extraction did not reach hold the mean features of the
+    positions it covered, for classifiers that expect the full feature map.
+    Input args:
+        fv (Dict). Feature dictionary returned by topo_psf_feature_extract.
+    Return:
+        fv (Dict). The same dictionary if every position is covered, a filled copy otherwise
+    """
+    mask=fv.get('coverage_mask')
+    if mask is None or mask.all():
+        return fv
+    fv=dict(fv)
+    psf=fv['psf_feature_pos'].clone()
+    topo=fv['topo_feature_pos'].clone()
+    for c in range(len(mask)):
+        covered=mask[c]
+        if not covered.any():
+            continue
+        psf[:, c][:, ~covered]=psf[:, c][:, covered].mean(1, keepdim=True)
+        topo[c][~covered.flatten()]=topo[c][covered.flatten()].mean(0)
+    fv['psf_feature_pos']=psf
+    fv['topo_feature_pos']=topo
+    return fv
+
+
+def make_prober(scheduler: PSFProbeScheduler, psf_config: Dict, deadline: float = None):
+    """
+    Scheduler the probe jobs are run with. With psf_config['stim_search']=='adaptive' only part of the stimulation
+    levels are probed, see AdaptiveStimSearch.
+    """
+    if psf_config.get('stim_search', 'grid')=='adaptive':
+        return AdaptiveStimSearch(scheduler, psf_config, deadline)
+    return scheduler
+
+
+def psf_sensitivity(pred: torch.tensor)-> float:
+    """
+    Largest change of any class confidence across the stimulation levels of one position. Activation only runs have
+    no logits and count as sensitive everywhere.
+    """
+    if not pred.shape[1]:
+        return float('inf')
+    conf=torch.nn.functional.softmax(pred.float(), 1)
+    return (conf.max(0)[0]-conf.min(0)[0]).max().item()
+
+
+def adaptive_psf_scan(scheduler: PSFProbeScheduler, builder: PSFFeatureBuilder, example_dict: Dict, psf_config: Dict, deadline: float = None)-> torch.tensor:
+    """
+    Coarse-to-fine PSF scan. The feature map is first probed on cells of psf_config['coarse_factor'] steps, probing
+    the top left position of every cell. Cells whose confidence changes by more than psf_config['refine_threshold']
+    across the stimulation levels are split in four and probed again, down to step_size. The features of a position
+    that is never probed are copied from the probed position of the cell covering it. Once the deadline has passed
+    no cell is refined any further.
+    Input args:
+        scheduler (PSFProbeScheduler). Scheduler running the probes, or an AdaptiveStimSearch over it.
+        builder (PSFFeatureBuilder). Builder the probed positions are added to.
+        example_dict (Dict). Dictionary contains clean input examples.
+        psf_config (Dict). PSF configuration.
+        deadline (float). Optional. time.time() after which the scan stops refining.
+    Return:
+        mask (torch.tensor). m*h*w boolean mask of the feature map positions that were probed
+    """
+    coarse_factor=max(int(psf_config.get('coarse_factor', COARSE_FACTOR)), 1)
+    threshold=psf_config.get('refine_threshold', REFINE_THRESHOLD)
+    h, w=builder.feature_map_h, builder.feature_map_w
+    jobs={(job.c, job.pos_ind): job for job in psf_probe_jobs(example_dict, psf_config)}
+    # Classes are indexed by their example_dict key, as in PSFFeatureBuilder.add
+    mask=torch.zeros(len(example_dict), h, w, dtype=torch.bool)
+
+    def split(x0, x1):
+        if x1-x0<=1:
+            return [(x0, x1)]
+        xm=(x0+x1+1)//2
+        return [(x0, xm), (xm, x1)]
+
+    # A cell is (c, row start, row end, column start, column end) and is represented by its top left position
+    cells=[(c, i, min(i+coarse_factor, h), j, min(j+coarse_factor, w)) for c in example_dict
+           for i in range(0, h, coarse_factor) for j in range(0, w, coarse_factor)]
+    score={}
+    while cells:
+        # The top left position of a split cell is also the top left of its first sub-cell and is not probed again
+        todo=[jobs[key] for key in dict.fromkeys((c, i0*w+j0) for c, i0, _, j0, _ in cells) if key not in score]
+        for job, pred, layer_act_list in scheduler.run(todo):
+            builder.add(job, pred, layer_act_list)
+            score[(job.c, job.pos_ind)]=psf_sensitivity(pred)
+            mask[(job.c,)+divmod(job.pos_ind, w)]=True
+        # Cells are filled with the topological features of their probed position
+        builder.drain()
+        refine=[]
+        out_of_time=deadline is not None and time.time()>deadline
+        for c, i0, i1, j0, j1 in cells:
+            if not out_of_time and (i1-i0>1 or j1-j0>1) and score[(c, i0*w+j0)]>threshold:
+                refine+=[(c, a0, a1, b0, b1) for a0, a1 in split(i0, i1) for b0, b1 in split(j0, j1)]
+                continue
+            # Fill the cell with the features of its probed position
+            builder.psf_feature_pos[:, c, i0:i1, j0:j1]=builder.psf_feature_pos[:, c, i0:i0+1, j0:j0+1]
+            builder.coverage_mask[c, i0:i1, j0:j1]=True
+            for topo_feature_pos in builder.metric_topo_feature_pos.values():
+                for i in range(i0, i1):
+                    topo_feature_pos[c, i*w+j0:i*w+j1]=topo_feature_pos[c, i0*w+j0]
+        cells=refine
+    logging.info(f"adaptive scan probed {int(mask.sum())} of {mask.numel()} positions")
+    return mask
+
+
+def precision_fidelity(
+        model: torch.nn.Module,
+        example_dict: Dict,
+        psf_config: Dict,
+        num_classes: int,
+        n_positions: int = PRECISION_CHECK,
+        sample_plan: Dict = None
+        )-> Dict:
+    """
+    Measure how far psf_config['precision'] drifts from fp32 on n_positions randomly drawn positions.
+    Input args:
+        model (torch.nn.Module). Target model.
+        example_dict (Dict). Dictionary contains clean input examples.
+        psf_config (Dict). PSF configuration.
+        num_classes (int). Number of output classes of the model.
+        n_positions (int). Number of (class example, position) probe jobs to compare.
+        sample_plan (Dict). Optional. Neuron sampling plan shared by both runs.
+    Return:
+        fidelity (Dict). Maximum absolute drift of the PSF and topological features, the PSF drift relative to the
+        fp32 magnitude, and whether the features and correlation matrices of the reduced precision run are finite
+    """
+    jobs=psf_probe_jobs(example_dict, psf_config)
+    rng=np.random.RandomState(0)
+    jobs=[jobs[i] for i in sorted(rng.choice(len(jobs), min(n_positions, len(jobs)), replace=False))]
+    feature={}
+    filtration_plans={}
+    for precision in ['fp32', psf_config['precision']]:
+        config=dict(psf_config, precision=precision, corr_methods=None)
+        builder=PSFFeatureBuilder(model, example_dict, config, num_classes)
+        builder.sample_plan=sample_plan
+        # Both runs use the filtration planned by the first
+        builder.filtration_plans=filtration_plans
+        with PSFProbeScheduler(model, example_dict, config, sample_plan) as scheduler:
+            for job, pred, layer_act_list in scheduler.run(jobs):
+                builder.add(job, pred, layer_act_list)
+        psf=torch.stack([builder.psf_feature_pos[(slice(None), job.c)+divmod(job.pos_ind, builder.feature_map_w)] for job in jobs])
+        topo=torch.stack([builder.topo_feature_pos[job.c, job.pos_ind] for job in jobs])
+        finite=bool(torch.isfinite(psf).all() and torch.isfinite(topo).all()) and \
+            all(np.isfinite(pd).all() for pd_list in builder.metric_PD_list.values() for pd in pd_list)
+        feature[precision]=(psf, topo, finite)
+    psf_ref, topo_ref, _=feature['fp32']
+    psf, topo, finite=feature[psf_config['precision']]
+    fidelity={
+        'precision': psf_config['precision'],
+        'n_positions': len(jobs),
+        'psf_max_abs': (psf-psf_ref).abs().max().item(),
+        'psf_max_rel': ((psf-psf_ref).abs().max()/(psf_ref.abs().max()+1e-30)).item(),
+        'topo_max_abs': (topo-topo_ref).abs().max().item(),
+        'topo_mean_abs': (topo-topo_ref).abs().mean().item(),
+        'finite': finite,
+    }
+    logging.info(f"{psf_config['precision']} fidelity on {len(jobs)} positions: psf drift {fidelity['psf_max_abs']:.3e} "
+                 f"(relative {fidelity['psf_max_rel']:.3e}), topo drift max {fidelity['topo_max_abs']:.3e} mean {fidelity['topo_mean_abs']:.3e}")
+    return fidelity
+
+
 def topo_psf_feature_extract(
         model: torch.nn.Module,
         example_dict: Dict,
@@ -158,14 +960,9 @@ def topo_psf_feature_extract(
     """
 
     logging.info("starting feature extraction..")
+    start=time.time()
 
-    step_size=psf_config['step_size']
-    stim_level=psf_config['stim_level']
-    patch_size=psf_config['patch_size']
     input_shape=psf_config['input_shape']
-    input_valuerange=psf_config['input_range']
-    n_neuron_sample=psf_config['n_neuron']
-    method=psf_config['corr_method']
     device=psf_config['device']
 
     # If true input examples are not given, use all blank images instead
@@ -177,152 +974,116 @@ def topo_psf_feature_extract(
     model=model.to(device)
 
     test_input=example_dict[0][0].to(device)
-    num_classes=int(model(test_input).shape[1])
-
-    stim_seq=np.linspace(input_valuerange[0], input_valuerange[1], stim_level)
-    # 2 represent score and conf
-    feature_map_h=len(range(0, input_shape[1]-patch_size+1, step_size))
-    feature_map_w=len(range(0, input_shape[2]-patch_size+1, step_size))
-    # PSF feature dim : 2*m*h*w*L*C
-    #  2: logits and confidence
-    #  m: numebr of input examples
-    #  h: feature map height
-    #  w: feature map width
-    #  L: number of stimulation levels
-    #  C: number of classes
-    psf_feature_pos=torch.zeros(
-        2,
-        len(example_dict.keys()),
-        feature_map_h, feature_map_w,
-        len(stim_seq), num_classes)
-    # 12 is the number of topological features (including dim1 and dim2 features)
-    topo_feature_pos=torch.zeros(
-        len(example_dict.keys()),
-        len(range(0, int(feature_map_h*feature_map_w))),
-        12
-    )
-
-    PH_list=[]
-    PD_list=[]
-    sparse_PD_list=[]
-    rips = Rips(verbose=False)
-    model=model.to(device)
-    progress=0
-    # For each class input examples, scan through pixels with step_size and modify corresponding pixel with different stimulation level.
-    # Forward all these modified images to the network and collect output logits and confidence
-    for c in example_dict:
-        input_eg=copy.deepcopy(example_dict[c][0])
-        feature_w_pos=0
-        for pos_w in range(0, input_shape[1]-patch_size+1, step_size):
-            feature_h_pos = 0
-            for pos_h in range(0, input_shape[2]-patch_size+1, step_size):
-                t0=time.time()
-                count=0
-                prob_input=input_eg.repeat(len(stim_seq),1,1,1)
-                for i in stim_seq:
-                    prob_input[count,:,
-                               int(pos_w):min(int(pos_w+patch_size), input_shape[1]),
-                               int(pos_h):min(int(pos_h+patch_size), input_shape[1])]=i
-                    count+=1
-                pred=[]
-                batch_size=8 if len(prob_input)>=32 else 1
-                if batch_size==1:
-                    prob_input=prob_input.to(device)
-                    feature_dict_c, output = feature_collect(model, prob_input)
-                    pred.append(output.detach().cpu())
-                else:
-                    for b in range(int(len(prob_input)/batch_size)):
-                        prob_input_batch=prob_input[(8*b):min(8*(b+1), len(prob_input))].to(device)
-                        feature_dict_c, output = feature_collect(model, prob_input_batch)
-                        pred.append(output.detach().cpu())
-                pred=torch.cat(pred)
-                psf_score=pred
-                psf_conf=torch.nn.functional.softmax(psf_score, 1)
-
-                psf_feature_pos[0, c, feature_w_pos, feature_h_pos]=psf_score
-                psf_feature_pos[1, c, feature_w_pos, feature_h_pos]=psf_conf
-
-                # Extract intermediate activating vectors
-                neural_act = []
-                for k in feature_dict_c:
-                    if len(feature_dict_c[k][0].shape)==3:
-                        layer_act = [feature_dict_c[k][i].max(1)[0].max(1)[0].unsqueeze(1) for i in range(len(feature_dict_c[k]))]
-                    else:
-                        layer_act = [feature_dict_c[k][i].unsqueeze(1) for i in range(len(feature_dict_c[k]))]
-                    layer_act=torch.cat(layer_act, dim=1)
-                    # Standardize the activation layer-wisely
-                    layer_act=(layer_act-layer_act.mean(1, keepdim=True))/(layer_act.std(1, keepdim=True)+1e-30)
-                    neural_act.append(layer_act)
-                neural_act=torch.cat(neural_act)
-                layer_list=parse_arch(model)
-                sample_n_neurons_list=None
-                if len(neural_act)>1.5e3:
-                    neural_act, sample_n_neurons_list=sample_act(neural_act, layer_list, sample_size=n_neuron_sample)
-
-                model_file = cache_dir.split('/')[-1]
-                logging.info(f"building neural correlation matrix for {model_file} {pos_w} {pos_h}..")
-
-                # Build neural correlation matrix
-                if method=='distcorr':
-                    neural_pd=mat_discorr_adjacency(neural_act)
-                elif method=='bc':
-                    neural_act=torch.softmax(neural_act, 1)
-                    neural_pd=mat_bc_adjacency(neural_act)
-                elif method=='cos':
-                    neural_pd=mat_cos_adjacency(neural_act)
-                elif method=='pearson':
-                    neural_pd=mat_pearson_adjacency(neural_act)
-                elif method=='js':
-                    neural_act=torch.softmax(neural_act, 1)
-                    neural_pd=mat_jsdiv_adjacency(neural_act)
-                else:
-                    raise Exception(f"Correlation metrics {method} doesn't implemented !")
-
-                D=1-neural_pd.detach().cpu().numpy() if method!='bc' else -np.log(neural_pd.detach().cpu().numpy()+1e-6)
-                PD_list.append(neural_pd.detach().cpu().numpy())
-
-                # Approaximate sparse filtration to further save some computation
-                if model._get_name=='ModdedLeNet5Net':
-                    PH=rips.fit_transform(D, distance_matrix=True)
-                else:
-                    lambdas=getGreedyPerm(D)
-                    D = getApproxSparseDM(lambdas, 0.1, D)
-                    # sparse_PD_list.append(D)
-                    PH=rips.fit_transform(D, distance_matrix=True)
-
-                PH[0]=np.array(PH[0])
-                PH[1]=np.array(PH[1])
-                PH[0][np.where(PH[0]==np.inf)]=1
-                PH[1][np.where(PH[1]==np.inf)]=1
-                PH_list.append(PH)
-
-                # Compute the topological feature with the persistent diagram
-                clean_feature_0=calc_topo_feature(PH, 0)
-                clean_feature_1=calc_topo_feature(PH, 1)
-                topo_feature=[]
-                for k in sorted(list(clean_feature_0)):
-                    topo_feature.append(clean_feature_0[k])
-                for k in sorted(list(clean_feature_1)):
-                    topo_feature.append(clean_feature_1[k])
-                topo_feature=torch.tensor(topo_feature)
-                topo_feature_pos[c, int(feature_w_pos*feature_map_w+feature_h_pos), :]=topo_feature
-                feature_h_pos+=1
-
-            feature_w_pos+=1
-
-    if cache_dir:
-        with open(f"{cache_dir}/PH_list.pkl", "wb") as f:
-            pickle.dump(PH_list, f)
-        f.close()
-        # with open(f"{cache_dir}/PD_list.pkl", "wb") as f:
-        #     pickle.dump(PD_list, f)
-        # f.close()
-
-
-    fv={}
-    fv['psf_feature_pos']=psf_feature_pos
-    fv['topo_feature_pos']=topo_feature_pos
-    fv['correlation_matrix']=np.vstack([x[None, :, :] for x in PD_list]).mean(0)
+    with torch.no_grad():
+        num_classes=int(model(test_input).shape[1])
+
+    # Persistent diagrams are computed by a pool of processes while the next positions are probed
+    with make_ph_pool(psf_config) as ph_pool:
+        builder=PSFFeatureBuilder(model, example_dict, psf_config, num_classes, cache_dir, ph_pool)
+        fidelity=None
+        # Reduced precision runs are first compared with fp32 on a few positions
+        if psf_config.get('precision', 'fp32')!='fp32' and psf_config.get('precision_check', PRECISION_CHECK):
+            fidelity=precision_fidelity(model, example_dict, psf_config, num_classes, psf_config.get('precision_check', PRECISION_CHECK), builder.sample_plan)
+            if not fidelity['finite']:
+                logging.warning(f"{psf_config['precision']} probing gives non-finite features or correlations, falling back to fp32")
+                psf_config=dict(psf_config, precision='fp32')
+        # The probes of all positions are packed into memory-bounded batches by the scheduler, which hands back the output
+        # logits and intermediate activations position by position
+        # The recorder hooks come off the model once probing is done
+        with PSFProbeScheduler(model, example_dict, psf_config, builder.sample_plan) as scheduler:
+            # Anytime mode, positions are processed until the wall-clock budget of the model runs out
+            time_budget=psf_config.get('time_budget')
+            deadline=start+time_budget if time_budget else None
+            prober=make_prober(scheduler, psf_config, deadline)
+            mask=None
+            if psf_config.get('scan', 'uniform')=='adaptive':
+                mask=adaptive_psf_scan(prober, builder, example_dict, psf_config, deadline)
+            else:
+                for job, pred, layer_act_list in prober.run(psf_probe_jobs(example_dict, psf_config)):
+                    builder.add(job, pred, layer_act_list)
+                    if deadline is not None and time.time()>deadline:
+                        logging.warning(f"time budget of {time_budget}s ran out, {int(builder.coverage_mask.sum())} of {builder.coverage_mask.numel()} positions covered")
+                        break
+        fv=builder.finalize()
+    if mask is not None:
+        fv['psf_mask']=mask
+    if prober is not scheduler:
+        fv['stim_search']={'probes': prober.n_probes, 'dense': prober.n_dense}
+        logging.info(f"adaptive stimulation search probed {prober.n_probes} of {prober.n_dense} stimulation levels")
+    if fidelity:
+        fv['precision_fidelity']=fidelity
+    fv['timing']={'total': time.time()-start, 'warmup': scheduler.warmup_time}
+    if ph_pool is not None:
+        fv['timing']['ph_pool']=dict(ph_pool.stats)
+        logging.info(f"persistent homology pool: {ph_pool.stats}")
+    logging.info(f"feature extraction of {model._get_name()} took {fv['timing']['total']:.2f}s (warm-up {fv['timing']['warmup']:.2f}s)")
     return fv
 
 
+def topo_psf_feature_extract_multi(
+        models: List[torch.nn.Module],
+        example_dicts: List[Dict],
+        psf_config: Dict,
+        cache_dirs: List[str] = None
+        )-> List[Dict]:
+    """
+    Extract topological features from several models of the same architecture. Their parameters are stacked and
+    every probe batch goes through all of them in a single vmap-ed pass.
+    Input args:
+        models (List). Target models, all with the same architecture and number of classes.
+        example_dicts (List). Dictionaries of clean input examples of every model, all with the same class keys. If
+            None then all blank images are used.
+        cache_dirs (List). Optional. Cache folder of every model.
+    Return:
+        fv_list (List). Feature dictionary of every model, in the order of models
+    """
+    if len(models)==1:
+        return [topo_psf_feature_extract(models[0], example_dicts[0] if example_dicts else None, psf_config, cache_dirs[0] if cache_dirs else None)]
+
+    if psf_config.get('scan', 'uniform')=='adaptive':
+        # Every model refines its own cells, so the models no longer share their probe batches
+        logging.warning("adaptive scan is not supported by stacked extraction, extracting the models one by one")
+        return [topo_psf_feature_extract(models[k], example_dicts[k] if example_dicts else None, psf_config, cache_dirs[k] if cache_dirs else None) for k in range(len(models))]
+
+    logging.info(f"starting stacked feature extraction of {len(models)} models..")
+    start=time.time()
+
+    input_shape=psf_config['input_shape']
+    device=psf_config['device']
+    cache_dirs=cache_dirs if cache_dirs else [None]*len(models)
+
+    if not example_dicts or not all(example_dicts):
+        logging.warning("No input examples are given, using blank images instead!!")
+        example_dict=defaultdict(list)
+        example_dict[0].append(torch.zeros(input_shape).unsqueeze(0))
+        example_dicts=[example_dict]*len(models)
+
+    models=[model.to(device) for model in models]
+    test_input=example_dicts[0][0][0].to(device)
+    with torch.no_grad():
+        num_classes=int(models[0](test_input).shape[1])
+
+    # One pool computes the persistent diagrams of all models
+    with make_ph_pool(psf_config) as ph_pool:
+        builders=[PSFFeatureBuilder(models[k], example_dicts[k], psf_config, num_classes, cache_dirs[k], ph_pool) for k in range(len(models))]
+        sample_plans=[builder.sample_plan for builder in builders]
+        with StackedProbeScheduler(models, example_dicts, psf_config, sample_plans if sample_plans[0] is not None else None) as scheduler:
+            # The models share their probes, so they share the sum of their time budgets
+            time_budget=psf_config.get('time_budget')
+            deadline=start+time_budget*len(models) if time_budget else None
+            # pred is L*K*C and every layer activation K*n_l*L
+            for job, pred, layer_act_list in make_prober(scheduler, psf_config, deadline).run(psf_probe_jobs(example_dicts[0], psf_config)):
+                for k in range(len(models)):
+                    builders[k].add(job, pred[:, k], [x[k] for x in layer_act_list])
+                if deadline is not None and time.time()>deadline:
+                    logging.warning(f"time budget of {time_budget}s per model ran out, {int(builders[0].coverage_mask.sum())} of {builders[0].coverage_mask.numel()} positions covered")
+                    break
+        fv_list=[builder.finalize() for builder in builders]
+    for fv in fv_list:
+        fv['timing']={'total': time.time()-start, 'warmup': scheduler.warmup_time}
+        if ph_pool is not None:
+            fv['timing']['ph_pool']=dict(ph_pool.stats)
+    if ph_pool is not None:
+        logging.info(f"persistent homology pool: {ph_pool.stats}")
+    logging.info(f"stacked feature extraction of {len(models)} models took {time.time()-start:.2f}s (warm-up {scheduler.warmup_time:.2f}s)")
+    return fv_list
@@ -18,6 +18,7 @@ from tqdm import tqdm
 import sys
 sys.path.append("./TopoTrojDetection/")
 from run_crossval import run_crossval_xgb
+from topological_feature_extractor import fill_uncovered
 import xgboost as xgb
 from sklearn import preprocessing
 from sklearn.metrics import roc_auc_score
@@ -155,7 +156,8 @@ def featurize(models: List[ModelData]):
 
     CLASSES = 5 # FIXME don't hardcode this
     n_classes = CLASSES
-    fv_list = [x.fv for x in models]
+    # Time-budgeted extraction may leave positions uncovered
+    fv_list = [fill_uncovered(x.fv) for x in models]
     # ph_list = [x.PH_list for x in models]
     # exit(0)
     gt_list = [x.label for x in models]
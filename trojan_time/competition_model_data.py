@@ -233,14 +233,15 @@ class ModelData:
 
        def protocol(eg_idx, class_idx):
            ft_eg = topo_feature_pos[eg_idx,:,:]
-
-           def map_idx(idx):
-               h = idx % 14
-               w = idx//14
-               return w, h
-
-           v = sort_vectors_by_outlierness(ft_eg)
-           return v[:samples,]
+           # Only the positions a time-budgeted extraction covered
+           if 'coverage_mask' in self.fv and self.fv['coverage_mask'][eg_idx].any():
+               ft_eg = ft_eg[self.fv['coverage_mask'][eg_idx].flatten()]
+
+           v = sort_vectors_by_outlierness(ft_eg)[:samples,]
+           # Too few covered positions, the missing rows repeat the mean vector as fill_uncovered does
+           if len(v) < samples:
+               v = np.concatenate((v, np.repeat(v[:1], samples-len(v), axis=0)), axis=0)
+           return v
 
 
        for i in range(5):
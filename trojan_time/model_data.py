@@ -24,8 +24,8 @@ from typing import List, Dict, Any
 from dataclasses import dataclass
 import matplotlib.pyplot as plt
 import logging
-import copy
-from topo_utils import mat_bc_adjacency, parse_arch, feature_collect, sample_act, mat_discorr_adjacency, mat_cos_adjacency, mat_jsdiv_adjacency, mat_pearson_adjacency
+from topo_utils import DCOR_MEM_MB, STREAMING_CORR, ActivationRecorder, StreamingCorrelation, make_sample_plan, get_act_reducer, mat_bc_adjacency, parse_arch, select_layers, feature_collect, sample_act, mat_discorr_adjacency, mat_cos_adjacency, mat_jsdiv_adjacency, mat_pearson_adjacency
+from probe_utils import ProbeJob, PSFProbeDataset
 
 
 # from topological_feature_extractor import topo_psf_feature_extract
@@ -43,6 +43,7 @@ CLASSIFIER: str  = 'xgboost'    # Classifier for the detection , choice = {xgboo
 INPUT_SIZE: List = [1, 28, 28] # Input images' shape (default to be MNIST)
 INPUT_RANGE: List = [0, 255]   # Input image range
 TRAIN_TEST_SPLIT: float = 0.8  # Ratio of train to test
+PROBE_BATCH_SIZE: int = 256    # Number of perturbed images forwarded at once
 
 
 
@@ -192,27 +193,39 @@ class ModelData:
         method=self.troj_config['corr_method']
 
         stim_seq=np.linspace(input_valuerange[0], input_valuerange[1], stim_level)
-        # 2 represent score and conf
-        feature_map_h=len(range(0, self.data_dim[0]-patch_size+1, step_size))
-        feature_map_w=len(range(0, self.data_dim[1]-patch_size+1, step_size))
-        num_per_class = len(stim_seq) * feature_map_h * feature_map_w
-
-        perturbed_imgs = []
-        for c in range(self.num_classes):
-            input_eg = copy.deepcopy(self.examples[c])
-            perturbed = input_eg.repeat(num_per_class, 1, 1, 1)
-            cnt = 0
-            for pos_w in range(0, self.data_dim[0]-patch_size+1, step_size):
-                for pos_h in range(0, self.data_dim[1]-patch_size+1, step_size):
-                    for i in range(len(stim_seq)):
-                        stim = stim_seq[i]
-                        perturbed[cnt,0,pos_w:pos_w+patch_size, pos_h:pos_h+patch_size] = stim
-                        cnt+=1
-            perturbed_imgs.append(perturbed)
-        prob_input = torch.cat(perturbed_imgs, dim = 0)
+        positions=[(pos_w, pos_h) for pos_w in range(0, self.data_dim[0]-patch_size+1, step_size) for pos_h in range(0, self.data_dim[1]-patch_size+1, step_size)]
+        jobs=[ProbeJob(c, pos_ind, pos_w, pos_h, stim_seq) for c in range(self.num_classes) for pos_ind, (pos_w, pos_h) in enumerate(positions)]
+
+        # perturbations are synthesized batch by batch on the model's device instead of one giant host tensor
+        device = next(self.model.parameters()).device
+        example_dict = {c: [self.examples[c]] for c in range(self.num_classes)}
+        probe_dataset = PSFProbeDataset(example_dict, jobs, patch_size, device, batch_size=PROBE_BATCH_SIZE)
         pred = []
-        feature_dict_c, output = feature_collect(self.model, prob_input)
-        pred.append(output.detach())
+        layer_acts = []
+        # conv inputs are reduced to one value per neuron on the device, inside the hooks
+        layer_ind = select_layers(self.model, self.troj_config)
+        layer_list, layer_k=parse_arch(self.model)
+        layer_list=([layer_list[i] for i in layer_ind], [layer_k[i] for i in layer_ind])
+        # Pearson and cosine only need running moments, every batch is folded in and dropped
+        stream = None
+        channels = None
+        sample_n_neurons_list=None
+        if method in STREAMING_CORR:
+            sample_plan = make_sample_plan(layer_list, layer_ind, n_neuron_sample)
+            if sample_plan is not None:
+                channels = {i: torch.as_tensor(ch, dtype=torch.long) for i, ch in zip(layer_ind, sample_plan['channels']) if len(ch)}
+                layer_ind = list(channels)
+        recorder = ActivationRecorder(self.model, capacity=PROBE_BATCH_SIZE, pin_memory=True, reducer=get_act_reducer(self.troj_config), layer_ind=layer_ind, channels=channels)
+        with torch.no_grad(), recorder:
+            for _, prob_input in probe_dataset:
+                feature_dict_c, output = recorder.record(prob_input)
+                pred.append(output.detach().cpu())
+                if method in STREAMING_CORR:
+                    batch_act = torch.cat([x.T for x in feature_dict_c.values()])
+                    stream = stream or StreamingCorrelation(len(batch_act))
+                    stream.update(batch_act)
+                else:
+                    layer_acts.append([x.clone() for x in feature_dict_c.values()])
         pred = torch.cat(pred)
 
         psf_score=pred
@@ -224,22 +237,20 @@ class ModelData:
         # psf_feature_pos[0, c, feature_w_pos, feature_h_pos]=psf_score
         # psf_feature_pos[1, c, feature_w_pos, feature_h_pos]=psf_conf
 
+        if stream is not None:
+            # the activations were never materialized, standardization is applied to the moments
+            self.neural_act = None
+            self.neural_pd = STREAMING_CORR[method](stream, standardize=True)
+            return
+
         # Extract intermediate activating vectors
         neural_act = []
-        # print(neural_act)
-        # print(feature_dict_c)
-        for k in feature_dict_c:
-            if len(feature_dict_c[k][0].shape)==3:
-                layer_act = [feature_dict_c[k][i].max(1)[0].max(1)[0].unsqueeze(1) for i in range(len(feature_dict_c[k]))]
-            else:
-                layer_act = [feature_dict_c[k][i].unsqueeze(1) for i in range(len(feature_dict_c[k]))]
-            layer_act=torch.cat(layer_act, dim=1)
+        for l in range(len(layer_acts[0])):
+            layer_act=torch.cat([x[l] for x in layer_acts]).T
             # Standardize the activation layer-wisely
             layer_act=(layer_act-layer_act.mean(1, keepdim=True))/(layer_act.std(1, keepdim=True)+1e-30)
             neural_act.append(layer_act)
         neural_act=torch.cat(neural_act)
-        layer_list=parse_arch(model)
-        sample_n_neurons_list=None
         if len(neural_act)>1.5e3:
             neural_act, sample_n_neurons_list=sample_act(neural_act, layer_list, sample_size=n_neuron_sample)
         print("Neural act", neural_act.shape, neural_act)
@@ -248,9 +259,10 @@ class ModelData:
         self.neural_act = neural_act
 
 
-        # trimming the activation tensor otherwise memory limit exceeded
-        neural_pd=mat_discorr_adjacency(neural_act[:,:1000])
+        # the distance tensor is accumulated blockwise once it exceeds the memory cap, no trimming needed
+        neural_pd=mat_discorr_adjacency(neural_act, max_mem_mb=self.troj_config.get('dcor_mem_mb', DCOR_MEM_MB))
         print(neural_pd.shape)
+        self.neural_pd = neural_pd
         # print(layer_act.shape, layer_act)
         # exit(0)
         pass